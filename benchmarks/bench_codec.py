@@ -0,0 +1,114 @@
+#! /usr/bin/python3
+#
+# JPEG decode / encode throughput of the codec.py backends (PIL, and
+# TurboJPEG if installed), on a folder of scans, or on synthetic pages at
+# scan size (see synthetic.py) if none is given:
+#
+#   decode at full size, in the DCT domain at 1/2, 1/4 and 1/8, luma only;
+#   encode with the source quantization tables, and at a fixed quality.
+#
+# Times are per page, best of --repeat, MP/s in source pixels. The last
+# column is the speedup over PIL.
+#
+import argparse
+import json
+import sys
+import time
+from io import BytesIO
+from os import listdir, path
+
+from PIL import Image, JpegImagePlugin
+
+sys.path.insert(0, path.dirname(path.dirname(path.realpath(__file__))))
+import codec
+from synthetic import synthetic_page
+
+# 600 dpi US comic page
+SCAN_SIZE = (3975, 6113)
+SYNTHETIC_PAGES = 4
+
+
+def load_pages(folder, count):
+    if folder:
+        names = sorted(i for i in listdir(folder) if path.splitext(i)[1].lower() in ['.jpg', '.jpeg'])
+        pages = []
+        for name in names[:count] if count else names:
+            with open(path.join(folder, name), 'rb') as f:
+                pages.append(f.read())
+        return pages
+    pages = []
+    for seed in range(count or SYNTHETIC_PAGES):
+        buf = BytesIO()
+        synthetic_page(SCAN_SIZE, seed=seed).save(buf, 'JPEG', quality=90)
+        pages.append(buf.getvalue())
+    return pages
+
+
+# name, function(data, page, backend); page: (decoded image, quantization tables, subsampling)
+# (PIL decodes lazily, hence the load())
+def cases():
+    for scale in [1, 2, 4, 8]:
+        yield 'decode 1/{}'.format(scale), \
+            lambda data, page, b, scale=scale: codec.decode(data, 'RGB', [i // scale for i in page[0].size], b).load()
+    yield 'decode luma', lambda data, page, b: codec.decode(data, 'L', None, b).load()
+    yield 'encode tables', lambda data, page, b: codec.encode(page[0], None, page[1], page[2], b)
+    yield 'encode q85', lambda data, page, b: codec.encode(page[0], 85, None, None, b)
+
+
+def best(fn, repeat):
+    fn()    # warm up
+    t = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        elapsed = time.perf_counter() - start
+        t = elapsed if t is None else min(t, elapsed)
+    return t
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('folder', nargs='?', help='folder of JPEG scans (default: synthetic {}x{} pages)'.format(*SCAN_SIZE))
+    parser.add_argument('-n', '--pages', type=int, help='use the first N pages')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--json', help='write the results to this file')
+    args = parser.parse_args()
+
+    backends = ['pil'] + (['turbojpeg'] if codec.available() else [])
+    if not codec.available():
+        print ('turbojpeg not available (pip install PyTurboJPEG, and libturbojpeg), PIL only')
+
+    pages = load_pages(args.folder, args.pages)
+    decoded = []
+    for data in pages:
+        src = Image.open(BytesIO(data))
+        img = codec.decode(data, src.mode, None, 'pil')
+        img.load()
+        decoded.append((img, src.quantization, JpegImagePlugin.get_sampling(src)))
+    mpixels = sum(page[0].size[0] * page[0].size[1] for page in decoded) / 1e6
+    print ('{} page(s), {:.1f} Mpixels'.format(len(pages), mpixels))
+
+    results = []
+    print ('{:<14} {:<10} {:>12} {:>10} {:>8} {:>8}'.format('case', 'backend', 'ms/page', 'MP/s', 'tables', 'speedup'))
+    for name, fn in cases():
+        pil_time = None
+        for backend in backends:
+            t = sum(best(lambda: fn(data, page, backend), args.repeat) for data, page in zip(pages, decoded))
+            pil_time = pil_time or t
+            # do the encoded pages have the source tables
+            kept = ''
+            if name == 'encode tables':
+                encoded = [Image.open(BytesIO(fn(data, page, backend))) for data, page in zip(pages, decoded)]
+                kept = '{}/{}'.format(sum(e.quantization == page[1] for e, page in zip(encoded, decoded)), len(pages))
+            print ('{:<14} {:<10} {:>12.1f} {:>10.1f} {:>8} {:>7.2f}x'.format(
+                name, backend, t * 1000 / len(pages), mpixels / t, kept, pil_time / t))
+            results.append({'case': name, 'backend': backend, 'pages': len(pages), 'seconds': t,
+                'mpixels_per_second': mpixels / t, 'tables_kept': kept or None})
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=1)
+
+
+if __name__ == '__main__':
+    main()
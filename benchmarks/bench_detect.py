@@ -0,0 +1,88 @@
+#! /usr/bin/python3
+#
+# Panel detection at full resolution vs. on a downscaled proxy image:
+# time per page, and accuracy (IoU against the full resolution panels)
+#
+import argparse
+import sys
+import time
+from os import listdir, path
+
+import numpy as np
+from PIL import Image
+
+sys.path.insert(0, path.dirname(path.dirname(path.realpath(__file__))))
+from panelize import downscale, image_to_array, panelize_contours, upscale_rects
+
+
+def iou(a, b):
+    x1, y1 = max(a[0], b[0]), max(a[1], b[1])
+    x2, y2 = min(a[0]+a[2], b[0]+b[2]), min(a[1]+a[3], b[1]+b[3])
+    inter = max(0, x2-x1) * max(0, y2-y1)
+    union = a[2]*a[3] + b[2]*b[3] - inter
+    return inter / union if union else 0
+
+
+# mean over the reference panels of the best matching IoU
+def mean_iou(reference, panels):
+    if not reference:
+        return 1.0 if not panels else 0.0
+    return np.mean([max([iou(r, p) for p in panels], default=0) for r in reference])
+
+
+def detect(im, height, repeat=3):
+    size = (im.shape[1], im.shape[0])
+    best = None
+    for _ in range(repeat):
+        # panelize_contours draws on the image
+        copy = im.copy()
+        start = time.perf_counter()
+        proxy, factor = downscale(copy, height)
+        panels,_,_ = panelize_contours(proxy, np.mean(proxy))
+        panels = upscale_rects(panels, factor, size)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return panels, best
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('input_dir', help='folder of sample pages')
+    parser.add_argument('--heights', nargs='+', type=int, default=[2560, 1920, 1280, 960, 640])
+    parser.add_argument('--min-size', type=int, default=8, help='ignore panels smaller than 1/N of the page (as --max-panels-per-edge)')
+    args = parser.parse_args()
+
+    pages = []
+    for f in sorted(listdir(args.input_dir)):
+        if path.splitext(f)[1].lower() in ['.jpg', '.jpeg', '.png']:
+            im = image_to_array(Image.open(path.join(args.input_dir, f)))
+            pages.append(im)
+    print ('{} page(s)'.format(len(pages)))
+
+    def big(im, panels):
+        min_size = min(im.shape[:2]) / args.min_size
+        return [p for p in panels if p[2] >= min_size and p[3] >= min_size]
+
+    reference = []
+    t_full = 0
+    for im in pages:
+        panels, t = detect(im, None)
+        reference.append(big(im, panels))
+        t_full += t
+
+    print ('{:>8} {:>12} {:>8} {:>10} {:>12}'.format('height', 'ms/page', 'speedup', 'mean IoU', 'count match'))
+    print ('{:>8} {:>12.1f} {:>8} {:>10.4f} {:>12}'.format('full', 1000*t_full/len(pages), '1.0x', 1, '100%'))
+    for height in args.heights:
+        t_proxy, ious, same_count = 0, [], 0
+        for im, ref in zip(pages, reference):
+            panels, t = detect(im, height)
+            panels = big(im, panels)
+            t_proxy += t
+            ious.append(mean_iou(ref, panels))
+            same_count += len(ref) == len(panels)
+        print ('{:>8} {:>12.1f} {:>7.1f}x {:>10.4f} {:>11.0f}%'.format(
+            height, 1000*t_proxy/len(pages), t_full/t_proxy, np.mean(ious), 100*same_count/len(pages)))
+
+
+if __name__ == '__main__':
+    main()
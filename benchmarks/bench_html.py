@@ -0,0 +1,80 @@
+#! /usr/bin/python3
+#
+# Page HTML serialization: lxml XHTML output vs. the former BeautifulSoup
+# prettify round trip. Checks that both produce the same DOM, and times them.
+#
+import argparse
+import sys
+import time
+from argparse import Namespace
+from os import path
+
+from bs4 import BeautifulSoup
+from lxml import etree as ET
+
+sys.path.insert(0, path.dirname(path.dirname(path.realpath(__file__))))
+from epub import Page, xhtml_tostring
+
+DOCTYPE = '<!DOCTYPE html SYSTEM "http://www.w3.org/TR/xhtml1/DTD/xhtml1-transitional.dtd">'
+
+
+def prettify(html):
+    html = ET.tostring(html, method='html', doctype=DOCTYPE, encoding='utf-8')
+    return BeautifulSoup(html, features='lxml', from_encoding='utf-8').prettify(formatter='html')
+
+
+# a page with a grid of n panels
+def synthetic_page(n):
+    size = (1600, 2400)
+    cols = max(1, int(n ** 0.5))
+    rows = -(-n // cols)
+    w, h = size[0] // cols, size[1] // rows
+    panels = [[(i % cols) * w + 10, (i // cols) * h + 10, w - 20, h - 20] for i in range(n)]
+    record = {
+        'filename': 'images/page-00000.jpg', 'size': list(size), 'landscape': False,
+        'bg': [255, 255, 255], 'panels': panels, 'state': [None, 2, 1],
+    }
+    return Page.from_record(record, (1072, 1448))
+
+
+# tag, attributes, stripped text and children; whitespace between elements does not count
+def dom(e):
+    return (e.tag, sorted(e.attrib.items()), (e.text or '').strip(), [dom(c) for c in e], (e.tail or '').strip())
+
+
+def parse(text):
+    if isinstance(text, str):
+        text = text.encode('utf-8')
+    return ET.fromstring(text, ET.XMLParser(remove_blank_text=True))
+
+
+def timed(fn, arg, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        result = fn(arg)
+    return (time.perf_counter() - start) / repeat, result
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--panels', type=int, nargs='+', default=[1, 6, 24, 96])
+    parser.add_argument('--repeat', type=int, default=20)
+    args = parser.parse_args()
+
+    ok = True
+    for js in [False, True]:
+        options = Namespace(js=js)
+        for n in args.panels:
+            page = synthetic_page(n)
+            html = page.html_tree('page-0', options, 'css/amzn-ke-style-page-0.css')
+            t_old, old = timed(prettify, html, args.repeat)
+            t_new, new = timed(lambda html: xhtml_tostring(html, DOCTYPE), html, args.repeat)
+            same = dom(parse(old)) == dom(parse(new))
+            ok = ok and same
+            print ('js={} panels={:3d}: prettify {:.2f} ms, xhtml {:.3f} ms, {:.0f}x, same DOM: {}'.format(
+                js, n, t_old * 1000, t_new * 1000, t_old / t_new, same))
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == '__main__':
+    main()
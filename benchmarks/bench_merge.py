@@ -0,0 +1,86 @@
+#! /usr/bin/python3
+#
+# Micro-benchmark for panelize.merge, on synthetic sets of contour rectangles
+#
+import argparse
+import sys
+import time
+from os import path
+
+sys.path.insert(0, path.dirname(path.dirname(path.realpath(__file__))))
+from panelize import intersection, merge
+from synthetic import synthetic_rects
+
+
+# The original O(n^2) implementation, kept as reference for correctness
+class Rect:
+    def __init__(self,r):
+        self.r = r
+        self.connected = set()
+        self.group = None
+
+def visit_rect(rects, i, group):
+    stack = [i]
+    while stack:
+        r = rects[stack.pop()]
+        if r.group is None:
+            r.group = group
+            stack.extend(r.connected)
+
+def reference_merge(areas):
+    rects = [Rect(r) for r in areas]
+    num_rects = len(rects)
+    for i in range(0, num_rects):
+        for j in range(i+1, num_rects):
+            if intersection(rects[i].r, rects[j].r):
+                rects[i].connected.add(j)
+                rects[j].connected.add(i)
+    for i, r in enumerate(rects):
+        visit_rect(rects, i, i)
+    union = {}
+    for r in rects:
+        x,y,w,h = r.r
+        x1,y1,x2,y2 = union.setdefault(r.group, (x,y,x+w,y+h))
+        union[r.group] = (min(x,x1), min(y,y1), max(x+w,x2), max(y+h,y2))
+    items = union.items()
+    delete = set()
+    for k,(x1,y1,x2,y2) in items:
+        for j,(_x1,_y1,_x2,_y2) in items:
+            if j!=k and x1 >= _x1 and y1 >= _y1 and x2 <= _x2 and y2 <= _y2:
+                delete.add(k)
+    for k in delete:
+        del union[k]
+    return [(x1,y1,x2-x1,y2-y1) for _,(x1,y1,x2,y2) in items]
+
+
+def bench(fn, rects, repeat):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = fn(list(rects))
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sizes', nargs='+', type=int, default=[100, 1000, 10000, 100000])
+    parser.add_argument('--reference-max', type=int, default=3000, help='largest set to run the O(n^2) reference on')
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    print ('{:>8} {:>8} {:>12} {:>12} {:>8}'.format('rects', 'panels', 'merge (s)', 'reference', 'speedup'))
+    for n in args.sizes:
+        rects = synthetic_rects(n)
+        t, result = bench(merge, rects, args.repeat)
+        if n <= args.reference_max:
+            t_ref, expected = bench(reference_merge, rects, 1)
+            assert result == expected, 'merge result differs from reference for {} rects'.format(n)
+            print ('{:>8} {:>8} {:>12.5f} {:>12.5f} {:>7.1f}x'.format(n, len(result), t, t_ref, t_ref/t))
+        else:
+            print ('{:>8} {:>8} {:>12.5f} {:>12} {:>8}'.format(n, len(result), t, '-', '-'))
+
+
+if __name__ == '__main__':
+    main()
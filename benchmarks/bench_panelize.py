@@ -0,0 +1,128 @@
+#! /usr/bin/python3
+#
+# Micro-benchmarks for the panelize.py hot functions, on synthetic pages
+# (see synthetic.py), at several page sizes / contour counts:
+#
+#   time per call (best of --repeat), throughput, peak of the memory allocated
+#   through Python / numpy during the call and the number of blocks it left
+#   allocated (tracemalloc; OpenCV's own buffers are not traced), and the
+#   scaling exponent: time ~ size^k, between consecutive sizes.
+#
+# Runs offline and is deterministic, --quick for CI, --json to keep the numbers.
+#
+import argparse
+import json
+import math
+import sys
+import time
+import tracemalloc
+from os import path
+
+sys.path.insert(0, path.dirname(path.dirname(path.realpath(__file__))))
+from panelize import auto_threshold, downscale, image_to_array, merge, panelize_contours, panelize_crop, sort_panels
+from synthetic import synthetic_page, synthetic_rects
+
+HEIGHTS = [600, 1200, 2400, 4800]
+QUICK_HEIGHTS = [600, 1200]
+RECT_COUNTS = [100, 1000, 10000, 30000]
+QUICK_RECT_COUNTS = [100, 1000]
+
+
+def page(height):
+    return synthetic_page((height * 2 // 3, height))
+
+
+def gray_page(height):
+    return image_to_array(page(height))
+
+
+# Each case: name, unit of the size axis, setup(size) -> arguments, function.
+# Functions that modify their input get a fresh copy from setup on every call.
+def cases(heights, rect_counts):
+    yield 'image_to_array', 'px', heights, lambda h: (page(h),), image_to_array
+    for method in ['auto', 'otsu', 'triangle']:
+        yield 'auto_threshold/' + method, 'px', heights, lambda h: (gray_page(h),), \
+            lambda img, method=method: auto_threshold(img, method=method)
+    yield 'downscale(h/4)', 'px', heights, lambda h: (gray_page(h),), lambda img: downscale(img, img.shape[0] // 4)
+    yield 'panelize_contours', 'px', heights, lambda h: (gray_page(h),), \
+        lambda img: panelize_contours(img.copy(), auto_threshold(img, binarize=False)[0])
+    yield 'panelize_crop', 'px', heights, lambda h: (gray_page(h),), \
+        lambda img: panelize_crop(img, auto_threshold(img, binarize=False)[0])
+    yield 'merge', 'rects', rect_counts, lambda n: (synthetic_rects(n),), lambda rects: merge(list(rects))
+    yield 'sort_panels', 'rects', rect_counts, lambda n: (gray_page(1200), synthetic_rects(n)), sort_panels
+
+
+def measure(fn, args, repeat):
+    fn(*args)   # warm up
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn(*args)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+
+    # allocations, measured apart: tracing slows the calls down
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    fn(*args)
+    after = tracemalloc.take_snapshot()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    blocks = sum(stat.count_diff for stat in after.compare_to(before, 'filename'))
+    return best, peak, blocks
+
+
+# pixels for pages, else the count itself
+def size_of(unit, size):
+    if unit == 'px':
+        return size * (size * 2 // 3)
+    return size
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--heights', type=int, nargs='+', help='page heights, default {}'.format(HEIGHTS))
+    parser.add_argument('--rects', type=int, nargs='+', help='contour counts, default {}'.format(RECT_COUNTS))
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--quick', action='store_true', help='small sizes only')
+    parser.add_argument('--only', nargs='+', help='run the cases whose name starts with one of these')
+    parser.add_argument('--json', help='write the results to this file')
+    args = parser.parse_args()
+
+    heights = args.heights or (QUICK_HEIGHTS if args.quick else HEIGHTS)
+    rect_counts = args.rects or (QUICK_RECT_COUNTS if args.quick else RECT_COUNTS)
+
+    results = []
+    print ('{:<24} {:>8} {:>12} {:>14} {:>11} {:>8} {:>6}'.format(
+        'function', 'size', 'time (ms)', 'throughput', 'peak (KB)', 'blocks', 'k'))
+    for name, unit, sizes, setup, fn in cases(heights, rect_counts):
+        if args.only and not any(name.startswith(i) for i in args.only):
+            continue
+        previous = None
+        for size in sizes:
+            fn_args = setup(size)
+            try:
+                t, peak, blocks = measure(fn, fn_args, args.repeat)
+            except Exception as e:
+                # (panelize_crop, which epub.py does not use, asserts on some pages)
+                print ('{:<24} {:>8} failed: {}'.format(name, size, repr(e)))
+                results.append({'function': name, 'size': size, 'unit': unit, 'error': repr(e)})
+                previous = None
+                continue
+            n = size_of(unit, size)
+            # scaling exponent against the previous size
+            k = math.log(t / previous[1]) / math.log(n / previous[0]) if previous else None
+            previous = n, t
+            throughput = '{:.1f} M{}/s'.format(n / t / 1e6, unit) if unit == 'px' else '{:.0f} K{}/s'.format(n / t / 1e3, unit)
+            print ('{:<24} {:>8} {:>12.3f} {:>14} {:>11.0f} {:>8} {:>6}'.format(
+                name, size, t * 1000, throughput, peak / 1024, blocks, '-' if k is None else '{:.2f}'.format(k)))
+            results.append({'function': name, 'size': size, 'unit': unit, 'n': n, 'seconds': t,
+                'peak_bytes': peak, 'blocks': blocks, 'exponent': k})
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=1)
+
+
+if __name__ == '__main__':
+    main()
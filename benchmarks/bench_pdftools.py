@@ -0,0 +1,93 @@
+#! /usr/bin/python3
+#
+# pdftools image extraction, serial vs. parallel, on a generated PDF.
+# Checks that both write the same files.
+#
+import argparse
+import contextlib
+import filecmp
+import io
+import shutil
+import sys
+import tempfile
+import time
+from os import listdir, makedirs, path
+
+import numpy as np
+from PIL import Image
+
+sys.path.insert(0, path.dirname(path.dirname(path.realpath(__file__))))
+from pdftools import extract, extract_parallel
+
+
+def synthetic_pages(count, size):
+    rng = np.random.default_rng(0)
+    w, h = size
+    for i in range(count):
+        a = np.full((h, w, 3), 255, dtype=np.uint8)
+        # a 2x3 grid of noisy panels, so that the JPEGs are not trivially small
+        for y in range(3):
+            for x in range(2):
+                y0, x0 = 20 + y * h // 3, 20 + x * w // 2
+                a[y0:y0 + h//3 - 40, x0:x0 + w//2 - 40] = rng.integers(0, 256, (h//3 - 40, w//2 - 40, 3), dtype=np.uint8) // 4 + i % 192
+        yield Image.fromarray(a)
+
+
+def make_pdf(filename, count, size):
+    pages = synthetic_pages(count, size)
+    first = next(pages)
+    first.save(filename, save_all=True, append_images=pages, resolution=150)
+
+
+def timed(fn, *args):
+    start = time.perf_counter()
+    # pdftools prints each file name
+    with contextlib.redirect_stdout(io.StringIO()):
+        count = fn(*args)
+    return time.perf_counter() - start, count
+
+
+def same_files(a, b):
+    files = sorted(listdir(a))
+    if files != sorted(listdir(b)):
+        return False
+    match, mismatch, errors = filecmp.cmpfiles(a, b, files, shallow=False)
+    return not mismatch and not errors
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--pages', type=int, default=300)
+    parser.add_argument('--size', type=int, nargs=2, default=[800, 1200])
+    parser.add_argument('-j', '--jobs', type=int, nargs='+', default=[2, 4])
+    parser.add_argument('--pdf', help='use this PDF instead of generating one')
+    args = parser.parse_args()
+
+    tmp = tempfile.mkdtemp()
+    try:
+        pdf = args.pdf
+        if not pdf:
+            pdf = path.join(tmp, 'bench.pdf')
+            start = time.perf_counter()
+            make_pdf(pdf, args.pages, args.size)
+            print ('Generated {} pages in {:.1f}s'.format(args.pages, time.perf_counter() - start))
+
+        for raw in [True, False]:
+            serial = path.join(tmp, 'serial')
+            shutil.rmtree(serial, ignore_errors=True)
+            makedirs(serial)
+            t1, count = timed(extract, pdf, serial, raw)
+            print ('{}: {} images, serial {:.2f}s'.format('raw' if raw else 'decode', count, t1))
+            for jobs in args.jobs:
+                out = path.join(tmp, 'jobs-{}'.format(jobs))
+                shutil.rmtree(out, ignore_errors=True)
+                makedirs(out)
+                t, n = timed(extract_parallel, pdf, out, raw, jobs)
+                print ('  jobs={}: {:.2f}s, speedup {:.2f}x, same output: {}'.format(
+                    jobs, t, t1 / t, n == count and same_files(serial, out)))
+    finally:
+        shutil.rmtree(tmp)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,63 @@
+#
+# Deterministic synthetic comic pages and contour sets for the benchmarks:
+# the same arguments always give the same pixels.
+#
+import random
+
+import cv2
+import numpy as np
+from PIL import Image
+
+
+# (x, y, w, h) of a rows x cols grid of panels, with gutters
+def panel_grid(size, rows, cols, gutter=None):
+    W, H = size
+    g = gutter or max(4, W // 60)
+    pw, ph = (W - g) // cols, (H - g) // rows
+    return [(g + c*pw, g + r*ph, pw - g, ph - g) for r in range(rows) for c in range(cols)]
+
+
+# A white page with a grid of bordered panels, filled with gray levels, a
+# halftone dot screen, noise and speech bubbles that cross the panel borders.
+def synthetic_page(size=(1600, 2400), rows=3, cols=2, bubbles=2, halftone=True, noise=8, seed=0):
+    rng = np.random.default_rng(seed)
+    W, H = size
+    img = np.full((H, W), 255, dtype=np.uint8)
+    border = max(2, W // 400)
+
+    for (x, y, w, h) in panel_grid(size, rows, cols):
+        img[y:y+h, x:x+w] = rng.integers(150, 230)
+        if halftone:
+            # dot screen over the lower half of the panel
+            pitch = max(4, W // 200)
+            yy, xx = np.mgrid[0:h - h//2, 0:w]
+            dots = ((xx % pitch - pitch//2)**2 + (yy % pitch - pitch//2)**2) < (pitch//3)**2
+            img[y+h//2:y+h, x:x+w][dots] = 40
+        # a few dark shapes inside the panel
+        for _ in range(3):
+            cx, cy = x + int(rng.integers(w//5, 4*w//5)), y + int(rng.integers(h//5, 4*h//5))
+            cv2.circle(img, (cx, cy), int(rng.integers(2, 8)) * w // 60, int(rng.integers(0, 80)), -1)
+        cv2.rectangle(img, (x, y), (x+w-1, y+h-1), 0, border)
+
+    for _ in range(bubbles * rows * cols // 2):
+        cx, cy = int(rng.integers(0, W)), int(rng.integers(0, H))
+        axes = (int(rng.integers(W//20, W//8)), int(rng.integers(H//40, H//16)))
+        cv2.ellipse(img, (cx, cy), axes, 0, 0, 360, 255, -1)
+        cv2.ellipse(img, (cx, cy), axes, 0, 0, 360, 0, border)
+
+    if noise:
+        img = np.clip(img + rng.normal(0, noise, img.shape), 0, 255).astype(np.uint8)
+    return Image.fromarray(img).convert('RGB')
+
+
+# n bounding boxes as found by findContours on a busy page: a 2x3 grid of
+# panel borders, lots of small bubble / halftone sized boxes
+def synthetic_rects(n, size=(3000, 4500), seed=0):
+    rnd = random.Random(seed)
+    W, H = size
+    rects = [(c*W//2 + 20, r*H//3 + 20, W//2 - 40, H//3 - 40) for r in range(3) for c in range(2)]
+    while len(rects) < n:
+        w, h = rnd.randint(2, 40), rnd.randint(2, 40)
+        rects.append((rnd.randint(0, W-w), rnd.randint(0, H-h), w, h))
+    rnd.shuffle(rects)
+    return rects[:n]
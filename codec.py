@@ -0,0 +1,143 @@
+#
+# JPEG decoding and encoding of the pages, with PIL, or with libjpeg-turbo's
+# TurboJPEG API (pip install PyTurboJPEG, plus the libturbojpeg library) when
+# asked for. Both backends take and give PIL images, and scale down in the
+# same steps, so the rest of the build does not care which one ran.
+#
+# PIL is the default: its wheels are built with libjpeg-turbo already, and
+# in benchmarks/bench_codec.py TurboJPEG was no faster to decode, and slower
+# to encode (the array copies).
+#
+# TurboJPEG takes a quality, not quantization tables. Tables that are the
+# standard (IJG) ones at some quality, which is what most encoders write, are
+# kept by encoding at that quality; pages with other tables go through PIL.
+#
+from io import BytesIO
+
+import numpy as np
+from PIL import Image
+
+try:
+    import turbojpeg
+    _turbo = turbojpeg.TurboJPEG()
+except (ImportError, OSError, RuntimeError):
+    # the module, or the library it loads, is missing
+    _turbo = None
+
+BACKENDS = ['auto', 'pil', 'turbojpeg']
+
+# quality PIL encodes at when not told otherwise
+DEFAULT_QUALITY = 75
+
+# IJG tables at quality 50, natural (row by row) order like PIL's
+LUMINANCE_TABLE = [
+    16, 11, 10, 16, 24, 40, 51, 61,
+    12, 12, 14, 19, 26, 58, 60, 55,
+    14, 13, 16, 24, 40, 57, 69, 56,
+    14, 17, 22, 29, 51, 87, 80, 62,
+    18, 22, 37, 56, 68, 109, 103, 77,
+    24, 35, 55, 64, 81, 104, 113, 92,
+    49, 64, 78, 87, 103, 121, 120, 101,
+    72, 92, 95, 98, 112, 100, 103, 99,
+]
+CHROMINANCE_TABLE = [
+    17, 18, 24, 47, 99, 99, 99, 99,
+    18, 21, 26, 66, 99, 99, 99, 99,
+    24, 26, 56, 99, 99, 99, 99, 99,
+    47, 66, 99, 99, 99, 99, 99, 99,
+] + [99] * 32
+
+
+def available():
+    return _turbo is not None
+
+
+# 'auto': turbojpeg if available
+def resolve(backend):
+    if backend == 'auto':
+        return 'turbojpeg' if _turbo else 'pil'
+    if backend == 'turbojpeg' and not _turbo:
+        raise RuntimeError('turbojpeg backend not available (pip install PyTurboJPEG, and install libturbojpeg)')
+    return backend
+
+
+# same as libjpeg's jpeg_set_quality(quality, force_baseline=TRUE)
+def scaled_table(table, quality):
+    scale = 5000 // quality if quality < 50 else 200 - quality*2
+    return [min(max((i*scale + 50) // 100, 1), 255) for i in table]
+
+
+_ijg_qualities = None
+
+# the quality that gives these tables (PIL's img.quantization), None if
+# they are not the standard ones
+def ijg_quality(qtables, mode):
+    global _ijg_qualities
+    if _ijg_qualities is None:
+        _ijg_qualities = {}
+        # lowest quality first, when several give the same tables
+        for q in range(100, 0, -1):
+            luma, chroma = scaled_table(LUMINANCE_TABLE, q), scaled_table(CHROMINANCE_TABLE, q)
+            _ijg_qualities[('L', tuple(luma))] = q
+            _ijg_qualities[('RGB', tuple(luma), tuple(chroma))] = q
+    tables = [tuple(qtables[i]) for i in sorted(qtables)]
+    # (a single channel is encoded with the first table, as PIL does)
+    if mode == 'L':
+        tables = tables[:1]
+    return _ijg_qualities.get(tuple([mode] + tables))
+
+
+# DCT domain scaling (1/2, 1/4, 1/8) to no less than size, as Image.draft
+def draft_scale(img_size, size):
+    if not size:
+        return 1
+    scale = min(img_size[0] // size[0], img_size[1] // size[1])
+    for s in [8, 4, 2, 1]:
+        if s <= scale:
+            return s
+
+
+# Decode a JPEG, scaled down to no less than size if given. Mode 'L'
+# decodes the luma only.
+def decode(data, mode, size=None, backend='pil'):
+    if resolve(backend) == 'turbojpeg' and mode in ['RGB', 'L']:
+        width, height, _, colorspace = _turbo.decode_header(data)
+        if colorspace not in [turbojpeg.TJCS_CMYK, turbojpeg.TJCS_YCCK]:
+            scale = draft_scale((width, height), size)
+            pixels = _turbo.decode(data,
+                pixel_format=turbojpeg.TJPF_GRAY if mode == 'L' else turbojpeg.TJPF_RGB,
+                scaling_factor=(1, scale) if scale > 1 else None)
+            return Image.fromarray(pixels[:, :, 0] if mode == 'L' else pixels, mode)
+
+    img = Image.open(BytesIO(data))
+    img.draft(mode, size)
+    return img if img.mode == mode else img.convert(mode)
+
+
+_turbo_subsampling = {0: 'TJSAMP_444', 1: 'TJSAMP_422', 2: 'TJSAMP_420'}
+
+# Encode img as JPEG, at quality, or with the quantization tables and
+# subsampling (JpegImagePlugin.get_sampling) of the source JPEG, or at
+# PIL's defaults.
+def encode(img, quality=None, qtables=None, subsampling=None, backend='pil'):
+    if resolve(backend) == 'turbojpeg' and img.mode in ['RGB', 'L']:
+        if quality or qtables is None or subsampling is None:
+            q, sampling = quality or DEFAULT_QUALITY, 'TJSAMP_420'
+        else:
+            q, sampling = ijg_quality(qtables, img.mode), _turbo_subsampling.get(subsampling)
+        if img.mode == 'L':
+            sampling = 'TJSAMP_GRAY'
+        if q and sampling:
+            pixels = np.asarray(img)
+            return _turbo.encode(pixels[:, :, None] if img.mode == 'L' else pixels, quality=q,
+                pixel_format=turbojpeg.TJPF_GRAY if img.mode == 'L' else turbojpeg.TJPF_RGB,
+                jpeg_subsample=getattr(turbojpeg, sampling))
+
+    buf = BytesIO()
+    if quality:
+        img.save(buf, 'JPEG', quality=quality)
+    elif qtables is None or subsampling is None:
+        img.save(buf, 'JPEG')
+    else:
+        img.save(buf, 'JPEG', subsampling=subsampling, qtables=qtables)
+    return buf.getvalue()
@@ -4,24 +4,61 @@
 #
 import argparse
 import contextlib
+import cProfile
+import hashlib
+import json
+import os
 import cv2
 import numpy as np
 import shutil
+import subprocess
+import sys
 import uuid
 import warnings
 import zipfile
 
-from bs4 import BeautifulSoup
-from panelize import auto_threshold, change_resolution, image_to_array, panelize_crop, panelize_contours
-from os import chdir, getcwd, listdir, makedirs, path, rename, walk
+from codec import BACKENDS as CODECS, available as codec_available, decode, encode, resolve as resolve_codec
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from io import BytesIO, StringIO
+from itertools import repeat
+from layout import css_declarations, output_factor, panel_layout, save_layout
+from panelcache import DEFAULT_CACHE, DEFAULT_MAX_ENTRIES, cache_key, open_cache
+from panelize import THRESHOLD_METHODS, auto_threshold, change_resolution, downscale, image_to_array, panelize_crop, panelize_contours, upscale_rects
+from os import chdir, getcwd, listdir, makedirs, path, remove, rename, stat, walk
 from PIL import Image, ImageDraw, JpegImagePlugin
+from profiling import Profiler, timed
+from sources import input_sources, is_archive, is_pdf
 from pathvalidate import sanitize_filepath
 from xml.dom import minidom
 from lxml import etree as ET
 
-MAX_SCALE_FACTOR = 0.98
 SCRIPT = 'navigate.js'
 
+# already compressed, deflating them again is a waste of time
+STORED_EXTENSIONS = ['.jpg', '.jpeg', '.png']
+
+# optional, for rotating landscape pages without re-encoding
+JPEGTRAN = shutil.which('jpegtran')
+EXIF_ORIENTATION = 0x0112
+
+# --output-resolution device: shrink by integer steps (Image.reduce) down to
+# this many times the output size, then resample the rest of the way
+RESAMPLE_REDUCING_GAP = 2.0
+
+
+# HTML elements that have no content, and are written as <img/>
+VOID_ELEMENTS = {'area', 'base', 'br', 'col', 'embed', 'hr', 'img', 'input', 'link', 'meta', 'param', 'source', 'track', 'wbr'}
+
+# Serialize as XHTML. Other empty elements get an end tag (<a ...></a>, not <a/>),
+# which HTML parsers would take for an open element.
+def xhtml_tostring(html, doctype):
+    for e in html.iter():
+        if e.tag not in VOID_ELEMENTS and e.text is None and len(e) == 0:
+            e.text = ''
+    return ET.tostring(html, encoding='utf-8', pretty_print=True, doctype=doctype)
+
+
 @contextlib.contextmanager
 def pushd(new_dir):
     previous_dir = getcwd()
@@ -32,79 +69,122 @@ def pushd(new_dir):
     finally:
         chdir(previous_dir)
 
-@contextlib.contextmanager
-def cleanup(args, dir):
-    try:
-        yield
-    finally:
-        if not args.no_cleanup:
-            print ('Cleaning up: {}'.format(dir))
-            shutil.rmtree(dir)
 
-def scale_perc(x, scale, size):
-    return '{}%'.format(round(100*x*scale/size, 2))
+# Stream the book content straight into the .epub archive, as it is produced.
+# Names are relative to the OEBPS folder.
+class EpubArchive:
+    def __init__(self, filename):
+        self.zipf = zipfile.ZipFile(filename, 'w', zipfile.ZIP_DEFLATED)
+        self.names = []
+        self.name_set = set()
+        # mimetype must be the first entry, and uncompressed
+        self.zipf.writestr('mimetype', 'application/epub+zip', zipfile.ZIP_STORED)
+        for f in sorted(listdir('META-INF')):
+            self.zipf.write(path.join('META-INF', f), 'META-INF/' + f)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exType, exValue, backtrace):
+        self.close()
+
+    def write(self, name, data):
+        if isinstance(data, str):
+            data = data.encode('utf-8')
+        if path.splitext(name)[1] in STORED_EXTENSIONS:
+            compress_type = zipfile.ZIP_STORED
+        else:
+            compress_type = zipfile.ZIP_DEFLATED
+        self.add_name(name)
+        self.zipf.writestr('OEBPS/' + name, data, compress_type)
+
+    # each name once: twice would be two zip members, and two OPF items, of the same name
+    def add_name(self, name):
+        if name in self.name_set:
+            raise Exception('{} written twice to the book'.format(name))
+        self.names.append(name)
+        self.name_set.add(name)
+
+    def close(self):
+        # (ZipFile.close does nothing the second time)
+        self.zipf.close()
+
+
+# Write the content out to a staging tree, and zip it up when done (for debugging).
+class EpubStagingTree(EpubArchive):
+    def __init__(self, filename, dir):
+        self.filename = filename
+        self.dir = dir
+        self.names = []
+        self.name_set = set()
+        self.closed = False
+        shutil.copytree('META-INF', path.join(dir, 'META-INF'), dirs_exist_ok=True)
+        with open(path.join(dir, 'mimetype'), 'w') as f:
+            f.write('application/epub+zip')
 
+    def exists(self, name):
+        return path.isfile(path.join(self.dir, 'OEBPS', name))
+
+    # add a file left in the tree by a previous build
+    def keep(self, name):
+        assert self.exists(name), name
+        self.add_name(name)
+
+    def write(self, name, data):
+        if isinstance(data, str):
+            data = data.encode('utf-8')
+        self.add_name(name)
+        fpath = path.join(self.dir, 'OEBPS', name)
+        makedirs(path.dirname(fpath), exist_ok=True)
+        with open(fpath, 'wb') as f:
+            f.write(data)
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        # remove leftovers from previous builds
+        names = set(self.names)
+        content_dir = path.join(self.dir, 'OEBPS')
+        for root,_,files in walk(content_dir):
+            for f in files:
+                fpath = path.join(root, f)
+                if path.relpath(fpath, content_dir).replace(path.sep, '/') not in names:
+                    remove(fpath)
+
+        print ('Staging tree kept: {}'.format(self.dir))
+        with EpubArchive(self.filename) as archive:
+            for name in self.names:
+                with open(path.join(self.dir, 'OEBPS', name), 'rb') as f:
+                    archive.write(name, f.read())
+
+
+def jpeg_rotate_lossless(data):
+    # same as Image.rotate(90, expand=True), but in the DCT domain
+    if not JPEGTRAN:
+        return None
+    cmd = [JPEGTRAN, '-rotate', '270', '-perfect', '-copy', 'none']
+    try:
+        return subprocess.run(cmd, input=data, stdout=subprocess.PIPE, stderr=subprocess.PIPE, check=True).stdout
+    except subprocess.CalledProcessError:
+        # -perfect fails if the image size is not a multiple of the MCU size
+        return None
 
 def detect_background_color(img):
-    # TODO: check all four corners? or is left-top enough for now?
-    a = np.array(img)
-    if len(a.shape) > 2:
-        color = tuple(a[0][0])
-    else:
-        color = (255,255,255)
-    return color
-
-
-class Panel:
-    def __init__(self, filename, img_size, xy, size):
-        assert len(xy)==2, xy
-        assert len(size)==2, size
-
-        self.xywh = list(xy) + list(size)
-        self.img_size = img_size
+    # most common color of the four corners, top-left wins ties
+    if len(img.getbands()) == 1:
+        return (255,255,255)
+    w, h = img.size
+    corners = [img.getpixel(xy) for xy in [(0, 0), (w-1, 0), (0, h-1), (w-1, h-1)]]
+    color = max(corners, key=corners.count)
+    return tuple(int(i) for i in color)
 
-        if True:
-            # corners as percentages
-            (self.left, self.top) = ['{}%'.format(round(i*100./j,2)) for i,j in zip(xy, img_size)]
-            (self.width, self.height) = ['{}%'.format(round(i*100./j,2)) for i,j in zip(size, img_size)]
-        else:
-            # ... as pixels
-            (self.left, self.top) = ['{}px'.format(i) for i in xy]
-            (self.width, self.height) = ['{}px'.format(i) for i in size]
-
-    def __str__(self):
-        return '{} left={}%, top={}%, width={}%, height={}%'.format(self.xywh, self.left, self.top, self.width, self.height)
-    
-    def max_scale(self, client_size):
-        scale = min([MAX_SCALE_FACTOR * i / j for i, j in zip(client_size, self.xywh[2:])])
-        return scale
-
-    # box (magTarget)
-    def zoom_target_box(self, scale, client_size):
-        _,_,w,h = self.xywh
-        # centered:
-        return {
-            'left':'{}%'.format(round(MAX_SCALE_FACTOR*50*(client_size[0]-w*scale)/client_size[0],2)),
-            'top': '{}%'.format(round(50*(client_size[1]-h*scale)/client_size[1],2)),
-            'width':  scale_perc(w, scale, client_size[0]),
-            'height': scale_perc(h, scale, client_size[1]),
-        }
 
-    # content (magTarget img)
-    def zoom_target_img_box(self, scale, client_size):
-        x,y,w,h = self.xywh
-        new_size = [i*scale for i in self.img_size]                
-        style = {
-            'top': '{}%'.format(round(-y*100/h, 2)),
-            'left': '{}%'.format(round(-x*100/w, 2)),
-            'width':'{}px'.format(int(new_size[0])),
-            'height':'{}px'.format(int(new_size[1])),
-
-            # work-around kindlegen
-            #'min-width':'{}px'.format(int(new_size[0])),
-            #'min-height':'{}px'.format(int(new_size[1])),
-        }
-        return style
+# --gray-levels: n evenly spaced levels from black to white, as e-ink
+# screens show them (16 on Kindles)
+def gray_levels_table(n):
+    step = 255 / (n - 1)
+    return [int(round(round(i / step) * step)) for i in range(256)]
 
 
 def panel_id(page, ordinal):
@@ -129,102 +209,272 @@ def add_fixed_layout_page_tags(args, metadata):
     ET.SubElement(metadata, 'meta', { 'name':'viewport', 'content':'width=device-width, initial-scale=1' })
 
 
-class Page:
-    threshold,kern_size,iters = None, 2, 1
+# everything that goes into detecting the panels of a page (the auto
+# threshold comes from the page itself)
+def detection_params(args):
+    return {
+        'threshold': args.threshold,
+        'threshold_method': args.threshold_method,
+        'max_panels_per_edge': args.max_panels_per_edge,
+        'min_panels': args.min_panels,
+        'scale': args.scale,
+        'detect_height': detection_height(args),
+        'grayscale': args.grayscale,
+        # the backends may not decode to exactly the same pixels
+        'codec': resolve_codec(args.codec),
+    }
+
+
+# height of the (proxy) image that panels are detected on, None for full resolution
+def detection_height(args):
+    if args.detect_resolution == 'full':
+        return None
+    if args.detect_resolution == 'client':
+        return args.client_size[1]
+    return int(args.detect_resolution)
+
+
+def panel_cache(args):
+    if args.no_panel_cache:
+        return None
+    return open_cache(args.panel_cache, args.panel_cache_size)
+
 
-    def _set_panels(self, args, img:Image, panels, bg):
+class Page:
+    def _set_panels(self, args, panels, bg):
         # filter out small panels
-        min_size = min(self.img.size)/args.max_panels_per_edge
+        min_size = min(self.size)/args.max_panels_per_edge
         panels = [(x,y,w,h) for (x,y,w,h) in panels if w >= min_size and h >= min_size]
 
         # enforce that page contains a minimum number of panels
-        have_sufficient_panels = (len(panels) >= args.min_panels)
-        if not have_sufficient_panels:
-            # reset auto computed params
-            Page.threshold, Page.kern_size, Page.iters = None, 2, 1
-
-        if have_sufficient_panels:
-            for (x,y,w,h) in panels:
-                self.panels.append(Panel(self.filename, img.size, (x,y), (w,h)))
+        if len(panels) < args.min_panels:
+            panels = []
+        self.panels = panel_layout(panels, self.size, self.client_size)
+        if args.output_resolution == 'device':
+            self._fit_output(panels)
         print ('{}: {} panels'.format(self.filename, len(self.panels)))
-        return self.img, bg
+        return bg
+
+    # shrink the page (and its panels) to the resolution the device shows
+    def _fit_output(self, panels):
+        factor = output_factor(self.panels, self.size, self.client_size)
+        size = tuple(max(1, int(round(i * factor))) for i in self.size)
+        if size == self.size:
+            return
+        fx, fy = size[0] / self.size[0], size[1] / self.size[1]
+        panels = [(round(x*fx), round(y*fy), max(1, round(w*fx)), max(1, round(h*fy))) for (x,y,w,h) in panels]
+        self.size = size
+        self.resampled = True
+        self.panels = panel_layout(panels, self.size, self.client_size)
+
+    # grayscale plane for panel detection, in page orientation
+    def _grayscale(self, args, data):
+        if not self.passthrough:
+            return image_to_array(self.img)
+        # the page pixels are not needed, decode the luma only
+        w, h = self.img.size
+        # (of the page once rotated, for landscape pages)
+        height = detection_height(args) or (w if self.landscape else h)
+        if self.landscape:
+            height = min(w, height) * h // w
+        im = np.array(decode(data, 'L', (w * height // h, height), args.codec))
+        if self.landscape:
+            im = cv2.rotate(im, cv2.ROTATE_90_COUNTERCLOCKWISE)
+        return im
+
+    def _detect_panels(self, args, data):
+        im = self._grayscale(args, data)
+        decoded_factor = self.size[1] / im.shape[0]
+        im, factor = downscale(im, detection_height(args))
+
+        threshold = args.threshold
+        if not threshold:
+            # of this page: the pages do not depend on the ones before them,
+            # or on how many jobs build them
+            if args.threshold_method == 'mean':
+                threshold = np.mean(im)
+            else:
+                threshold, _ = auto_threshold(im, method=args.threshold_method, binarize=False)
+            print ('auto threshold:', threshold)
+        #panels = panelize_crop(im, threshold)
+        #im = cv2.convertScaleAbs(im, alpha=2.5)
+        panels, _, _ = panelize_contours(im, threshold)
+        return upscale_rects(panels, factor * decoded_factor, self.size)
 
-    def _make_page(self, args, filename):
-        self.img = Image.open(filename)
+    # decode, scale and rotate the page
+    def _transform(self, args, img):
+        if args.scale != 1.0:
+            print ('Scaling image: {}'.format(args.scale))
+            img = img.resize([int(i*args.scale) for i in img.size])
+        if self.landscape:
+            img = img.rotate(90, expand=True)
+        return img
+
+    def _make_page(self, args, data):
+        cache = panel_cache(args)
+        key = cache_key(data, detection_params(args)) if cache else None
+        cached = cache.get(key) if cache else None
+
+        with timed(self.timings, 'decode', self.filename):
+            bg = self._open(args, data, cached)
+
+        # the detected background color, not the one given with --bg
+        detected_bg = [int(i) for i in bg] if isinstance(bg, tuple) else None
+        if cached:
+            panels = cached['panels']
+            if not args.bg and 'bg' not in cached:
+                cache.put(key, dict(cached, bg=detected_bg))
+        else:
+            with timed(self.timings, 'detect', self.filename):
+                panels = self._detect_panels(args, data)
+            if cache:
+                value = {'panels': [[int(i) for i in rect] for rect in panels]}
+                if not args.bg:
+                    value['bg'] = detected_bg
+                cache.put(key, value)
+        return self._set_panels(args, panels, bg)
+
+    # open the image and get the background color
+    def _open(self, args, data, cached):
+        self.img = Image.open(BytesIO(data))
         #self.img = change_resolution(self.img, [8.5, 11], 320, False)
         self.quantization = getattr(self.img, 'quantization', None)
         self.subsampling = JpegImagePlugin.get_sampling(self.img) if self.quantization else None
+        # the source JPEG can be copied as is if the pixels do not change
+        self.passthrough = (self.img.format == 'JPEG'
+            and args.scale == 1.0
+            and not args.jpg_quality
+            and self.img.getexif().get(EXIF_ORIENTATION, 1) == 1
+            and (not args.grayscale or (self.img.mode == 'L' and not args.gray_levels)))
+
+        mode = self.img.mode
+
+        # (see _fit_output)
+        self.resampled = False
+
+        if self.img.format == 'JPEG' and not self.passthrough:
+            # for --grayscale, the luma only
+            self.img = decode(data, 'L' if args.grayscale else mode, backend=args.codec)
+
+        w, h = [int(i*args.scale) for i in self.img.size] if args.scale != 1.0 else self.img.size
+        self.landscape = w > h
+        self.size = (h, w) if self.landscape else (w, h)
 
         if args.bg:
             bg = args.bg
             if bg.lower()=='none':
                 bg=None
+        elif cached and 'bg' in cached:
+            bg = tuple(cached['bg']) if cached['bg'] else None
+        elif self.passthrough or self.img.mode != mode:
+            # the corners at full resolution, a scaled down decode blurs them
+            bg = detect_background_color(decode(data, mode, backend=args.codec))
         else:
             bg = detect_background_color(self.img)
 
-        if args.scale != 1.0:
-            print ('Scaling image: {}'.format(args.scale))
-            self.img = self.img.resize([int(i*args.scale) for i in self.img.size])
-
-        self.landscape = self.img.size[0] > self.img.size[1]
-        if self.landscape:
-            self.img = self.img.rotate(90, expand=True)
-        
-        im = image_to_array(self.img)
-
-        threshold = args.threshold        
-        if not threshold:
-            if Page.threshold is None:
-                #Page.threshold, _ = auto_threshold(im)
-                Page.threshold = np.mean(im)
-                print ('auto threshold:', Page.threshold)
-            threshold = Page.threshold
-        #panels = panelize_crop(im, threshold)
-        #im = cv2.convertScaleAbs(im, alpha=2.5)
-        panels, Page.kern_size, Page.iters = panelize_contours(im, threshold, Page.kern_size, Page.iters)
-        return self._set_panels(args, self.img, panels, bg)
+        # when passing the JPEG through, the page is decoded only if need be
+        if not self.passthrough:
+            if args.grayscale:
+                # once: the pages are saved, and the panels detected, on this plane
+                self.img = self.img.convert('L')
+            self.img = self._transform(args, self.img)
+        return bg
 
-    def __init__(self, args, filename, output_dir, client_size):
-        self.output_dir = output_dir
+    def __init__(self, args, source, client_size):
         self.client_size = client_size        
-        self.panels = []
-        images_dir = 'images'
-        img_filename = sanitize_filepath(filename, platform='auto').replace(' ', '')
-        self.filename = path.join(images_dir, path.splitext(path.basename(img_filename))[0] + '.jpg')        
-        images_dir = path.join(output_dir, images_dir)
-        makedirs(images_dir, exist_ok=True)
-
-        (page, bg) = self._make_page(args, filename)
-
-        self.save(args, page, output_dir)
-        self.size = page.size
-        self.create_bg_image_file(images_dir, bg)
-
-
-    def save(self, args, page, output_dir):
+        # (see unique_image_names)
+        self.filename = source.image_name
+        # stage timings (see profiling.py), collected by the main process
+        self.timings = []
+
+        with timed(self.timings, 'read', self.filename):
+            data = source.read()
+
+        self.bg = self._make_page(args, data)
+
+        # encoded JPEG bytes, for the archive
+        with timed(self.timings, 'save', self.filename):
+            self.data = self.save(args, data)
+
+
+    def save(self, args, data):
+        if self.passthrough:
+            img = self.img
+            if self.resampled:
+                # decode no bigger than needed, the pixels change anyway
+                w, h = self.size
+                img = decode(data, img.mode, (h, w) if self.landscape else (w, h), args.codec)
+            else:
+                if self.landscape:
+                    data = jpeg_rotate_lossless(data)
+                if data:
+                    return data
+            self.img = self._transform(args, img)
+        if self.resampled:
+            self.img = self.img.resize(self.size, Image.BICUBIC, reducing_gap=RESAMPLE_REDUCING_GAP)
+        if args.gray_levels:
+            self.img = self.img.point(gray_levels_table(args.gray_levels))
+
+        page = self.img
         #page = change_resolution(page, [8.5, 11], 160, False)
-        fname = path.join(output_dir, self.filename)        
-        if args.jpg_quality:
-            page.save(fname, quality=args.jpg_quality)
-        elif self.subsampling is None:
-            page.save(fname)            
-        else:
-            page.save(fname, subsampling=self.subsampling, qtables=self.quantization)
+        return encode(page, args.jpg_quality, self.quantization, self.subsampling, args.codec)
 
     def enumerate_panels(self):
         return enumerate(self.panels, 1)
 
-    def create_bg_image_file(self, dir, bg_color):
+    # for incremental builds
+    def record(self):
+        return {
+            'filename': self.filename,
+            'size': list(self.size),
+            'landscape': self.landscape,
+            'bg': list(self.bg) if isinstance(self.bg, tuple) else self.bg,
+            'panels': [list(xywh) for xywh in self.panels[['x', 'y', 'w', 'h']].tolist()],
+        }
+
+    @staticmethod
+    def from_record(record, client_size):
+        page = Page.__new__(Page)
+        page.client_size = client_size
+        page.filename = record['filename']
+        page.size = tuple(record['size'])
+        page.landscape = record['landscape']
+        page.bg = tuple(record['bg']) if isinstance(record['bg'], list) else record['bg']
+        page.panels = panel_layout(record['panels'], page.size, client_size)
+        page.img = page.data = None
+        page.timings = []
+        return page
+
+    def create_bg_image_file(self, archive, grayscale=False):
+        bg_color = self.bg
         if not bg_color:
            print ('defaulting to white background') 
            bg_color = 'white'
 
-        fpath = path.join(dir, 'bg.png')
-        if not path.exists(fpath):
+        fpath = 'images/bg.png'
+        if fpath not in archive.name_set:
             bg = Image.new('RGB', self.client_size, bg_color)
-            bg.save(fpath)
+            if grayscale:
+                bg = bg.convert('L')
+            buf = BytesIO()
+            bg.save(buf, 'PNG')
+            archive.write(fpath, buf.getvalue())
+
+    # css: the stylesheet with the page's rules, a stylesheet of its own if None
+    def gen_html(self, root_name, args, archive, css=None):
+        if css is None:
+            css = self.gen_css(root_name, archive)
+        html = self.html_tree(root_name, args, css)
+
+        # write it out
+        fname = root_name + '.html'
+        print (fname)
+        doctype='<!DOCTYPE html SYSTEM "http://www.w3.org/TR/xhtml1/DTD/xhtml1-transitional.dtd">'
+        archive.write(fname, xhtml_tostring(html, doctype))
+        return (root_name, path.basename(fname), css)
 
-    def gen_html(self, root_name, args):
+    # css: the page stylesheet
+    def html_tree(self, root_name, args, css):
         html = ET.Element('html', {'xmlns': 'http://www.w3.org/1999/xhtml'})
         head = ET.Element('head')
         html.append(head)
@@ -249,7 +499,6 @@ class Page:
 
         # CSS
         head.append(ET.Element('link', css_link))
-        css = self.gen_css(root_name)
         css_link['href'] = css
         head.append(ET.Element('link', css_link))
 
@@ -293,68 +542,83 @@ class Page:
             img_src = self.filename
             div_target.append(ET.Element('img', {'src': img_src, 'class': 'target-mag'}))
 
-        # write it out
-        fname = path.join(self.output_dir, root_name) + '.html'
-        print (fname)
-        with open(fname, 'w') as f:
-            doctype='<!DOCTYPE html SYSTEM "http://www.w3.org/TR/xhtml1/DTD/xhtml1-transitional.dtd">'
-            html = ET.tostring(html, method='html', doctype=doctype, encoding='utf-8')
-            f.write(BeautifulSoup(html, features='lxml', from_encoding='utf-8').prettify(formatter='html'))
-        return (root_name, path.basename(fname), css)
+        return html
 
 
-    def gen_css(self, root_name):
+    def gen_css(self, root_name, archive):
         prefix = 'amzn-ke-style-'        
 
-        dir = path.join(self.output_dir, 'css')
-        fname = path.join(dir, path.join(path.dirname(root_name), prefix + path.basename(root_name) + '.css'))      
+        fname = '/'.join(['css', prefix + path.basename(root_name) + '.css'])
         print (fname)
-        with open(fname, 'w') as f:
-            f.write('div.fs {\n')
-            for i in ['top', 'bottom', 'left', 'right']:
-                f.write ('margin-{}: 0px;\n'.format(i))
-            w,h = self.client_size
-            f.write('width: {}px;\nheight: {}px;\n'.format(w, h))
-            f.write('}\n')
-            
-            f.write('img.singlePage {\n')
-            f.write('width: {}px;\nheight: {}px;\n'.format(w, h))
-            f.write('min-width: {}px;\nmin-height: {}px;\n'.format(w, h))
-            f.write('}\n')
-
-            for (ordinal, panel) in self.enumerate_panels():
-                id = panel_id(root_name, ordinal)
-                scale = panel.max_scale(self.client_size)
-
-                #region
-                f.write('#reg-{} '.format(id))
-                f.write('{\n')            
-                for i in [ 'top', 'left', 'height', 'width']:
-                    f.write('{}: {};\n'.format(i, getattr(panel, i)))
-                f.write('}\n')
-
-                # panel magnification box
-                f.write('#reg-{}-magTarget '.format(id))
-                f.write('{\n')
-                target = panel.zoom_target_box(scale, self.client_size)
-                for i in [ 'top', 'left', 'height', 'width']:
-                    f.write('{}: {};\n'.format(i, target[i]))
-                f.write('}\n')
-
-                # panel magnification img
-                f.write('#reg-{}-magTarget img '.format(id))
-                f.write('{\n')
+        with contextlib.closing(StringIO()) as f:
+            write_page_layout_css(f, self.client_size)
+            self.write_panel_css(f, root_name)
+            archive.write(fname, f.getvalue())
 
-                target = panel.zoom_target_img_box(scale, self.client_size)                
-                for i,v in target.items():
-                    f.write('{}: {};\n'.format(i,v))
+        return fname
 
+    # the region and magnification rules of the panels
+    def write_panel_css(self, f, root_name):
+        for ordinal, region, target, img in css_declarations(self.panels):
+            id = panel_id(root_name, ordinal)
+            for selector, declarations in [
+                    ('#reg-{}'.format(id), region),                     # region
+                    ('#reg-{}-magTarget'.format(id), target),           # panel magnification box
+                    ('#reg-{}-magTarget img'.format(id), img)]:         # panel magnification img
+                f.write(selector + ' {\n')
+                f.write(''.join('{}: {};\n'.format(k, v) for k, v in declarations))
                 f.write('}\n')
 
-        return path.join('css', path.basename(fname))
 
-
-def gen_content_opf(args, pages, output_dir):
+# the rules shared by all pages
+def write_page_layout_css(f, client_size):
+    f.write('div.fs {\n')
+    for i in ['top', 'bottom', 'left', 'right']:
+        f.write ('margin-{}: 0px;\n'.format(i))
+    w,h = client_size
+    f.write('width: {}px;\nheight: {}px;\n'.format(w, h))
+    f.write('}\n')
+
+    f.write('img.singlePage {\n')
+    f.write('width: {}px;\nheight: {}px;\n'.format(w, h))
+    f.write('min-width: {}px;\nmin-height: {}px;\n'.format(w, h))
+    f.write('}\n')
+
+
+# Panel rules of all pages in one stylesheet, or one per chunk of pages,
+# instead of one stylesheet per page. The selectors are already page scoped
+# (#reg-page-N-...). Kept in memory and written out once, by close().
+class SharedStylesheet:
+    def __init__(self, client_size, pages_per_file=0):
+        self.client_size = client_size
+        self.pages_per_file = pages_per_file
+        self.count = 0
+        self.files = {}
+
+    def fname(self, index):
+        if not self.pages_per_file:
+            return 'css/amzn-ke-style-pages.css'
+        return 'css/amzn-ke-style-pages-{}.css'.format(index // self.pages_per_file)
+
+    # add the rules of a page, return the stylesheet it goes in
+    def add(self, root_name, page):
+        fname = self.fname(self.count)
+        self.count += 1
+        if fname not in self.files:
+            self.files[fname] = StringIO()
+            write_page_layout_css(self.files[fname], self.client_size)
+        page.write_panel_css(self.files[fname], root_name)
+        return fname
+
+    def close(self, archive):
+        for fname, f in self.files.items():
+            print (fname)
+            archive.write(fname, f.getvalue())
+            f.close()
+        self.files = {}
+
+
+def gen_content_opf(args, pages, archive):
     package = ET.Element('package',
         {
             'unique-identifier': 'PrimaryID',
@@ -413,20 +677,23 @@ def gen_content_opf(args, pages, output_dir):
     spine = ET.Element('spine', {'toc':'ncx'})
     package.append(spine)
 
-    for _,_,files in walk(path.join(output_dir, 'images')):
-        for i,f in enumerate(files):
-            if f == 'cover.jpg':
-                continue
-            if f.endswith('.jpg'):
-                mime = 'image/jpeg'
-            elif f.endswith('.png'):
-                mime = 'image/png'
+    images = [f for f in archive.names if f.startswith('images/')]
+    for i,f in enumerate(images):
+        if f == 'images/cover.jpg':
+            continue
+        if f.endswith('.jpg'):
+            mime = 'image/jpeg'
+        elif f.endswith('.png'):
+            mime = 'image/png'
 
-            manifest.append(ET.Element('item', {'href': 'images/' + f, 'id': 'img-{}'.format(i), 'media-type': mime }))
+        manifest.append(ET.Element('item', {'href': f, 'id': 'img-{}'.format(i), 'media-type': mime }))
 
+    stylesheets = set()
     for (id, page, css) in pages:
         manifest.append(ET.Element('item', {'href': page, 'id': id, 'media-type': 'application/xhtml+xml' }))
-        manifest.append(ET.Element('item', {'href': css, 'id': id + '-css', 'media-type': 'text/css' }))
+        if css not in stylesheets:
+            stylesheets.add(css)
+            manifest.append(ET.Element('item', {'href': css, 'id': id + '-css', 'media-type': 'text/css' }))
         spine.append(ET.Element('itemref', {'idref': id, 'linear': 'yes' }))
     
     manifest.append(ET.Element('item', { 'href': 'css/amzn-ke-style-template.css', 'id':'css-template', 'media-type': 'text/css' }))
@@ -440,8 +707,7 @@ def gen_content_opf(args, pages, output_dir):
 
     # write content.opf
     content = ET.tostring(package, encoding='utf-8', pretty_print=True)
-    with open(path.join(output_dir, 'content.opf'), 'w') as f:
-        f.write(content.decode('utf-8'))
+    archive.write('content.opf', content)
 
 #
 # EPUB Toc, content, etc.
@@ -473,7 +739,7 @@ def toc_list_para(cls, href, text=None):
     return p
 
 
-def gen_toc_xhtml(args, pages, output_dir):
+def gen_toc_xhtml(args, pages, archive):
     html = ET.Element('html', {'xmlns': 'http://www.w3.org/1999/xhtml'}, nsmap={'epub': 'http://www.idpf.org/2007/ops'})
 
     head = ET.Element('head') 
@@ -505,11 +771,10 @@ def gen_toc_xhtml(args, pages, output_dir):
         toc_list.append(toc_list_item(id, page, id.replace('-', ' ')))
 
     toc = ET.tostring(html, encoding='utf-8', pretty_print=True, xml_declaration=True)
-    with open(path.join(output_dir, 'toc.xhtml'), 'w') as f:
-        f.write(toc.decode('utf-8'))
+    archive.write('toc.xhtml', toc)
 
 
-def gen_toc_xml(args, pages, output_dir):
+def gen_toc_xml(args, pages, archive):
     html = ET.Element('html', {'xmlns': 'http://www.w3.org/1999/xhtml'}, nsmap={'epub': 'http://www.idpf.org/2007/ops'})
     head = ET.Element('head')
     html.append(head)
@@ -531,16 +796,15 @@ def gen_toc_xml(args, pages, output_dir):
         div.append(toc_list_para('toc', page, id.replace('-', ' ')))
 
     toc = ET.tostring(html, encoding='utf-8', pretty_print=True)
-    with open(path.join(output_dir, 'toc.xml'), 'w') as f:
-        f.write(toc.decode('utf-8'))
+    archive.write('toc.xml', toc)
 
 
-def gen_toc(args, pages, output_dir):
-    gen_toc_xhtml(args, pages, output_dir)
-    gen_toc_xml(args, pages, output_dir)
+def gen_toc(args, pages, archive):
+    gen_toc_xhtml(args, pages, archive)
+    gen_toc_xml(args, pages, archive)
 
 
-def gen_ncx(args, pages, output_dir):
+def gen_ncx(args, pages, archive):
     ncx = ET.Element('ncx',
         {'version': '2005-1',
         '{http://www.w3.org/XML/1998/namespace}lang': 'en',
@@ -579,109 +843,443 @@ def gen_ncx(args, pages, output_dir):
 
     doctype = "<!DOCTYPE ncx PUBLIC '-//NISO//DTD ncx 2005-1//EN' 'http://www.daisy.org/z3986/2005/ncx-2005-1.dtd'>"
     navigation = ET.tostring(ncx, encoding='utf-8', pretty_print=True, xml_declaration=True, doctype=doctype)
-    with open(path.join(output_dir, 'toc.ncx'), 'w') as f:
-        f.write(navigation.decode('utf-8'))
+    archive.write('toc.ncx', navigation)
 
 
-def gen_navigation_files(args, pages, output_dir):
+def gen_navigation_files(args, pages, archive):
     if not args.no_toc:
-        gen_toc(args, pages, output_dir)
-    gen_ncx(args, pages, output_dir)
-
-
-def command_line_args():
-    parser = argparse.ArgumentParser()
-    parser.add_argument('input_dir', help='input dir')
+        gen_toc(args, pages, archive)
+    gen_ncx(args, pages, archive)
+
+
+# command line options that do not change the generated pages
+INCREMENTAL_IGNORED_OPTIONS = [
+    'input_dir', 'author', 'cover', 'title', 'no_toc', 'no_cleanup', 'incremental', 'jobs',
+    'no_panel_cache', 'panel_cache', 'panel_cache_size', 'profile', 'cprofile', 'batch', 'inputs',
+    'panel_layout',
+]
+
+# Keeps track of the inputs and outputs of each page between incremental builds.
+class BuildManifest:
+    def __init__(self, args, dir):
+        self.filename = path.join(dir, 'manifest.json')
+        self.options = {k:v for k,v in vars(args).items() if k not in INCREMENTAL_IGNORED_OPTIONS}
+        self.inputs = {}
+        self.previous = {}
+        if path.exists(self.filename):
+            with open(self.filename) as f:
+                manifest = json.load(f)
+            if manifest['options'] == json.loads(json.dumps(self.options)):
+                self.previous = manifest['inputs']
+            else:
+                print ('Options changed, rebuilding all pages')
+
+    @staticmethod
+    def file_hash(filename):
+        with open(filename, 'rb') as f:
+            return hashlib.sha256(f.read()).hexdigest()
+
+    # the page record of an unchanged input, or None
+    def lookup(self, source, archive):
+        # only pages made from files can be checked for changes
+        filename = source.path
+        if filename is None:
+            return None
+        entry = self.previous.get(filename)
+        if not entry or entry['page']['filename'] != source.image_name or not archive.exists(source.image_name):
+            return None
+        st = stat(filename)
+        if (st.st_mtime_ns, st.st_size) != (entry['mtime'], entry['size']):
+            if st.st_size != entry['size'] or self.file_hash(filename) != entry['sha256']:
+                return None
+            entry['mtime'] = st.st_mtime_ns
+        self.inputs[filename] = entry
+        return entry
+
+    def update(self, source, page, html, reused):
+        filename = source.path
+        if filename is None:
+            return
+        if reused:
+            entry = self.inputs[filename]
+        else:
+            st = stat(filename)
+            entry = {'mtime': st.st_mtime_ns, 'size': st.st_size, 'sha256': self.file_hash(filename)}
+        entry['page'] = page.record()
+        entry['html'] = html
+        self.inputs[filename] = entry
+
+    def save(self):
+        with open(self.filename + '.tmp', 'w') as f:
+            json.dump({'options': self.options, 'inputs': self.inputs}, f, indent=1)
+        rename(self.filename + '.tmp', self.filename)
+
+
+def init_worker():
+    # one OpenCV thread per worker process, the pool already uses all cores
+    cv2.setNumThreads(1)
+
+
+def make_page(args, source, client_size):
+    page = Page(args, source, client_size)
+    # do not ship the decoded image back to the main process
+    page.img = None
+    return page
+
+
+def worker_pool(args, mp_context=None):
+    return ProcessPoolExecutor(args.jobs, mp_context, initializer=init_worker)
+
+
+def image_name(name, suffix=''):
+    img_filename = sanitize_filepath(name, platform='auto').replace(' ', '')
+    return 'images/' + path.splitext(path.basename(img_filename))[0] + suffix + '.jpg'
+
+
+# Name the page image of each source (source.image_name): a.jpg and a.png
+# in a folder, or 001.jpg and 001.png in a .cbz, would both be images/a.jpg,
+# the second one is images/a-2.jpg. taken: names already in the book.
+def unique_image_names(sources, taken=()):
+    taken = set(taken)
+    for source in sources:
+        name, n = image_name(source.name), 1
+        while name in taken:
+            n += 1
+            name = image_name(source.name, '-{}'.format(n))
+        taken.add(name)
+        source.image_name = name
+        yield source
+
+
+# Yield (source, page) in input order.
+# reuse: pages of unchanged inputs (incremental build), by source name
+# executor: the worker pool (batch mode shares one between books), one is
+# started for the book if not given and args.jobs > 1
+def make_pages(args, sources, client_size, reuse={}, executor=None):
+    if executor is None and args.jobs > 1:
+        with worker_pool(args) as executor:
+            yield from make_pages(args, sources, client_size, reuse, executor)
+    elif executor:
+        # sources may be produced on the fly (PDF input), keep a bounded
+        # number of them in flight rather than reading them all up front
+        pending = deque()
+        for source in sources:
+            future = None if source.name in reuse else executor.submit(make_page, args, source, client_size)
+            pending.append((source, future))
+            while len(pending) > 2 * args.jobs:
+                source, future = pending.popleft()
+                yield source, reuse[source.name] if future is None else future.result()
+        # yield results in submission order, which is the spine order
+        for source, future in pending:
+            yield source, reuse[source.name] if future is None else future.result()
+    else:
+        for source in sources:
+            if source.name in reuse:
+                yield source, reuse[source.name]
+            else:
+                yield source, Page(args, source, client_size)
+
+
+# argv: the arguments to parse, default is the command line
+def command_line_args(argv=None, parser_class=argparse.ArgumentParser):
+    parser = parser_class()
+    parser.add_argument('input_dir', nargs='*', help='input dir, PDF file or comic archive (.cbz, .zip, .cbt, .tar); several make a batch')
+    parser.add_argument('--batch', metavar='FILE', help='build the books listed in FILE, one input per line')
     parser.add_argument('-a', '--author')
     parser.add_argument('-c', '--cover')
     parser.add_argument('-t', '--title')
     parser.add_argument('--bg', help='background color (default is automatic)')
     parser.add_argument('--js', action='store_true', help='embed Javascript for debugging')
     parser.add_argument('--scale', default=1.0, type=float)
-    parser.add_argument('--threshold', type=int, help='panel detection threshold')
+    parser.add_argument('--threshold', type=int, help='panel detection threshold (default: computed for each page)')
+    parser.add_argument('--threshold-method', choices=['mean'] + THRESHOLD_METHODS, default='mean',
+        help='how to compute the threshold when not given (default: mean)')
     # for determining the minimum required size of a panel
+    parser.add_argument('--detect-resolution', default='full', metavar='{full,client,HEIGHT}',
+        help='detect panels at full resolution, or on a proxy image scaled to the client size height or HEIGHT')
     parser.add_argument('--max-panels-per-edge', type=int, default=8)
     # don't panelize if less than min-panels detected
     parser.add_argument('--min-panels', type=int, default=3)
     parser.add_argument('-cs','--client-size', nargs=2, default=[960, 1280], type=int, metavar='INT')
+    parser.add_argument('--grayscale', action='store_true', help='single channel (8 bit gray) pages, for e-ink devices')
+    parser.add_argument('--gray-levels', type=int, choices=range(2, 257), metavar='[2-256]',
+        help='with --grayscale, round the pages to this many gray levels (16 for Kindles)')
+    parser.add_argument('--output-resolution', choices=['source', 'device'], default='source',
+        help='source: keep the page resolution; device: shrink pages to what the client size and panel zoom show')
     parser.add_argument('--jpg-quality', type=int, choices=range(1, 96), metavar='[1-95]')
+    parser.add_argument('--codec', choices=CODECS, default='pil',
+        help='JPEG decoder / encoder: pil (default), turbojpeg (PyTurboJPEG), or auto: turbojpeg if installed')
+    parser.add_argument('--no-panel-cache', action='store_true', help='always run panel detection')
+    parser.add_argument('--panel-cache', default=DEFAULT_CACHE, help='panel detection cache (default: %(default)s)')
+    parser.add_argument('--panel-cache-size', type=int, default=DEFAULT_MAX_ENTRIES, help='max pages in panel cache')
+    parser.add_argument('-j', '--jobs', type=int, default=1, help='number of worker processes (0: one per CPU)')
 
     parser.add_argument('--skip-landscape', action='store_true')
     parser.add_argument('--no-toc', action='store_true')
-    # for debugging
+    parser.add_argument('--profile', metavar='FILE', help='write per page, per stage timings to FILE (.json or .csv)')
+    parser.add_argument('--cprofile', metavar='FILE', help='write cProfile stats of the build to FILE')
+    parser.add_argument('--panel-layout', choices=['npz', 'json'],
+        help='also write the panel geometry of the book to <name>-panels.npz or .json')
+    parser.add_argument('--shared-css', type=int, nargs='?', const=0, metavar='PAGES',
+        help='put the panel rules of all pages in one stylesheet, or in one per PAGES pages')
+    # for debugging: write the book out to a staging tree, and keep it
     parser.add_argument('--no-cleanup', action='store_true')
-
-    args = parser.parse_args()
+    # keep the staging tree, and only rebuild pages whose input or options changed
+    parser.add_argument('--incremental', action='store_true')
+
+    args = parser.parse_intermixed_args(argv)
+    if args.detect_resolution not in ['full', 'client'] and not args.detect_resolution.isdigit():
+        parser.error('invalid --detect-resolution: {}'.format(args.detect_resolution))
+    if args.jobs <= 0:
+        args.jobs = os.cpu_count()
+    if args.gray_levels and not args.grayscale:
+        parser.error('--gray-levels needs --grayscale')
+    if args.codec == 'turbojpeg' and not codec_available():
+        parser.error('--codec turbojpeg: PyTurboJPEG or the libturbojpeg library is not installed')
+
+    args.inputs = list(args.input_dir)
+    if args.batch:
+        with open(args.batch) as f:
+            for line in f:
+                line = line.strip()
+                if line and not line.startswith('#'):
+                    # relative to the batch file
+                    args.inputs.append(path.join(path.dirname(args.batch), line))
+    if not args.inputs:
+        parser.error('no input dir, PDF file or comic archive')
+    if len(args.inputs) > 1 and (args.cover or args.title):
+        parser.error('--cover and --title are for building one book')
+    # the books are written to the current dir: series-a/issue1 and
+    # series-b/issue1 would both be issue1.epub
+    outputs = {}
+    for i in args.inputs:
+        if book_name(i):
+            outputs.setdefault(book_name(i) + '.epub', []).append(i)
+    for output, inputs in sorted(outputs.items()):
+        if len(inputs) > 1:
+            parser.error('{} would be written by several inputs: {}'.format(output, ', '.join(inputs)))
     return args
 
 
+# One book, made of the images in a folder, a PDF file or a comic archive, written to <name>.epub
+# the book of input_dir is <name>.epub, None if it is not a valid input
+def book_name(input_dir):
+    input_dir = path.realpath(input_dir)
+    if is_pdf(input_dir) or is_archive(input_dir):
+        return path.splitext(path.basename(input_dir))[0]
+    elif path.isdir(input_dir):
+        return path.basename(input_dir)
+    return None
+
+
+class Book:
+    # output: the .epub file, default is <name>.epub in the current dir
+    def __init__(self, args, input_dir, output=None):
+        # the options of the book, args.input_dir may list several in batch mode
+        self.args = argparse.Namespace(**vars(args))
+        self.args.input_dir = input_dir
+        self.input_dir = path.realpath(input_dir)
+        self.name = book_name(self.input_dir)
+        if not self.name:
+            raise Exception(self.input_dir + ' is not a directory, a PDF file or a comic archive')
+
+        self.output = output or self.name + '.epub'
+        self.profiler = Profiler(self.name)
+
+    # executor: worker pool shared with other books, see make_pages
+    def build(self, executor=None):
+        args = self.args
+        with self.profiler.stage('build'):
+            try:
+                self._build(executor)
+            except BaseException:
+                # do not leave a truncated book behind
+                if not (args.no_cleanup or args.incremental) and path.exists(self.output):
+                    remove(self.output)
+                raise
+
+    def _build(self, executor):
+        args = self.args
+        profiler = self.profiler
+        client_size = args.client_size
+        print ('Client size:', client_size)
+
+        manifest = None
+        if args.no_cleanup or args.incremental:
+            archive = EpubStagingTree(self.output, path.splitext(self.output)[0] + '-epub')
+            if args.incremental:
+                manifest = BuildManifest(args, archive.dir)
+        else:
+            archive = EpubArchive(self.output)
+
+        with archive:
+            if args.cover:
+                img = Image.open(args.cover)
+                buf = BytesIO()
+                img.save(buf, 'JPEG')
+                archive.write('images/cover.jpg', buf.getvalue())
+
+            sources = unique_image_names(input_sources(self.input_dir, args.cover), archive.names)
+
+            reuse = {}
+            if manifest:
+                sources = list(sources)
+                for source in sources:
+                    entry = manifest.lookup(source, archive)
+                    if entry:
+                        reuse[source.name] = Page.from_record(entry['page'], client_size)
+                print ('Incremental build: {} of {} page(s) unchanged'.format(len(reuse), len(sources)))
+
+            stylesheet = None
+            if args.shared_css is not None:
+                stylesheet = SharedStylesheet(client_size, args.shared_css)
+
+            pages = []
+            # panel tables of the pages, for --panel-layout
+            layouts = []
+            for source, page in make_pages(args, sources, client_size, reuse, executor):
+                profiler.extend(page.timings)
+                page.create_bg_image_file(archive, args.grayscale)
+                reused = source.name in reuse
+                html = None
+                if page.landscape and args.skip_landscape:
+                    print ('Landscape image skipped: {}'.format(path.basename(page.filename)))
+                else:
+                    if reused:
+                        archive.keep(page.filename)
+                    else:
+                        with profiler.stage('write', page.filename):
+                            archive.write(page.filename, page.data)
+                        page.data = None
+                    root_name = 'page-{}'.format(len(pages))
+                    page.panels['page'] = len(pages)
+                    layouts.append(page.panels)
+                    css = None
+                    if stylesheet:
+                        with profiler.stage('css', page.filename):
+                            css = stylesheet.add(root_name, page)
+                    previous = manifest.inputs[source.path]['html'] if reused else None
+                    if previous and previous[0] == root_name and all(archive.exists(i) for i in previous[1:]) \
+                            and css in [None, previous[2]]:
+                        # same page, same place in the book
+                        html = tuple(previous)
+                        archive.keep(html[1])
+                        if not stylesheet:
+                            archive.keep(html[2])
+                    else:
+                        if css is None:
+                            with profiler.stage('css', page.filename):
+                                css = page.gen_css(root_name, archive)
+                        with profiler.stage('html', page.filename):
+                            html = page.gen_html(root_name, args, archive, css)
+                    pages.append(html)
+                if manifest:
+                    manifest.update(source, page, html, reused)
+
+            if stylesheet:
+                with profiler.stage('css'):
+                    stylesheet.close(archive)
+
+            # generate debug script for navigating panels
+            if args.js:
+                with open('script/zoom.js') as sf:
+                    script = sf.read()
+                    archive.write(SCRIPT, 'var page_count = {}\n'.format(len(pages)) + script)
+
+            # 'resource' files
+            res_files = ['css/amzn-ke-style-template.css']
+            for f in res_files:
+                with open(f, 'rb') as rf:
+                    archive.write(f, rf.read())
+
+            if args.panel_layout:
+                fname = path.splitext(self.output)[0] + '-panels.' + args.panel_layout
+                save_layout(fname, np.concatenate(layouts or [panel_layout([], None, None)]), client_size)
+
+            with profiler.stage('opf'):
+                gen_content_opf(args, pages, archive)
+            with profiler.stage('navigation'):
+                gen_navigation_files(args, pages, archive)
+
+            # zip it up
+            with profiler.stage('close'):
+                archive.close()
+
+        if manifest:
+            manifest.save()
+
+
+# books in progress at a time in batch mode: the pages of the next book keep
+# the workers busy while the previous one is finished (html, zip, etc.)
+BATCH_BOOKS_IN_FLIGHT = 2
+
+def build_book(args, input_dir, executor=None):
+    book = Book(args, input_dir)
+    book.build(executor)
+    return book
+
+
+# Build many books, with one pool of workers for the pages of all of them.
+# Each book is written out as soon as its pages are done. A book that fails
+# is reported, and the batch goes on. Returns the books built, and the
+# (input dir, exception) of the failed ones.
+def build_batch(args, inputs):
+    books, failed = [], []
+
+    def run(input_dir, executor=None):
+        try:
+            book = build_book(args, input_dir, executor)
+        except Exception as e:
+            failed.append((input_dir, e))
+            print ('Failed {}: {!r}'.format(input_dir, e))
+        else:
+            books.append(book)
+            print ('Built {}'.format(book.output))
+
+    if args.jobs > 1:
+        with worker_pool(args) as executor:
+            # fork the workers now, while this is the only thread: forked from
+            # a book thread, they could inherit a lock another one holds
+            executor.submit(abs, 0).result()
+            with ThreadPoolExecutor(BATCH_BOOKS_IN_FLIGHT) as books_executor:
+                list(books_executor.map(run, inputs, repeat(executor)))
+    else:
+        for i in inputs:
+            run(i)
+
+    print ('Batch: {} of {} book(s) built'.format(len(books), len(inputs)))
+    for input_dir, e in failed:
+        print ('  failed: {}: {!r}'.format(input_dir, e))
+    return books, failed
+
+
 def main():
     args = command_line_args()
-    client_size = args.client_size
-    print ('Client size:', client_size)
-    
-    input_dir = path.realpath(args.input_dir)
+    # (of the main process only, pages built by --jobs workers are not in it)
+    profile = cProfile.Profile() if args.cprofile else None
+    if profile:
+        profile.enable()
+    try:
+        if len(args.inputs) == 1:
+            books, failed = [build_book(args, args.inputs[0])], []
+        else:
+            books, failed = build_batch(args, args.inputs)
+    finally:
+        if profile:
+            profile.disable()
+            profile.dump_stats(args.cprofile)
 
-    if not path.isdir(input_dir): 
-        raise Exception(input_dir + ' is not a directory')
+    if args.profile:
+        profiler = Profiler()
+        for book in books:
+            profiler.records += book.profiler.records
+        profiler.print_summary()
+        profiler.save(args.profile)
 
-    output = path.basename(input_dir) + '.epub'
-    output_dir = path.basename(input_dir) + '-epub'    
+    if failed:
+        sys.exit(1)
 
-    with cleanup(args, output_dir):
-        # setup META-INF and mimetype
-        shutil.copytree('META-INF', path.join(output_dir, 'META-INF'))    
-        with open(path.join(output_dir, 'mimetype'), 'w') as f:
-            f.write('application/epub+zip')
-        
-        # prepare content and CSS output locations
-        output_dir = path.join(output_dir, 'OEBPS')
-        css_dir = path.join(output_dir, 'css')
-        makedirs(css_dir)
-
-        if args.cover:
-            img = Image.open(args.cover)
-            cover = path.join(output_dir, 'images')
-            makedirs(cover)
-            cover = path.join(cover, 'cover.jpg')
-            img.save(cover)
-        
-        pages = []
-        for f in sorted(listdir(input_dir)):
-            if path.splitext(f)[1] in [ '.jpg', '.png']:
-                f = path.join(input_dir, f)
-                if args.cover and path.realpath(f)==path.realpath(args.cover):
-                    continue
-                page = Page(args, f, output_dir, client_size)
-                if page.landscape and args.skip_landscape:
-                    print ('Landscape image skipped: {}'.format(path.basename(f)))
-                    continue
-                i = len(pages)
-                pages.append(page.gen_html('page-{}'.format(i), args))
 
-        # generate debug script for navigating panels
-        if args.js:
-            with open('script/zoom.js') as sf:
-                script = sf.read()
-                with open(path.join(output_dir, SCRIPT), 'w') as df:
-                    df.write('var page_count = {}\n'.format(len(pages)))
-                    df.write(script)
-
-        # 'resource' files
-        res_files = ['css/amzn-ke-style-template.css']
-        for f in res_files:
-            shutil.copy(f, path.join(output_dir, f))            
-
-        gen_content_opf(args, pages, output_dir)
-        gen_navigation_files(args, pages, output_dir)
-
-        with zipfile.ZipFile(output, 'w', zipfile.ZIP_DEFLATED) as zipf:
-            for root,_,files in walk(path.dirname(output_dir)):
-                for file in files:
-                    fpath = path.join(root, file)
-                    arcname = '/'.join(str(fpath).split('/')[1:])
-                    zipf.write(fpath, arcname)
-    
 if __name__ == '__main__':    
     with pushd(path.dirname(__file__)):
         main()
@@ -8,8 +8,12 @@ from calibre.ebooks.mobi.writer8.mobi import KF8Book
 from calibre.ebooks.mobi.writer8.exth import EXTH_CODES
 from calibre.ebooks.oeb.reader import OEBReader
 
+import argparse
+import multiprocessing
 import sys
-from os import path
+import time
+import traceback
+from os import listdir, path
 
 amzn_exth_codes = {
     u'fixed-layout': 122,
@@ -41,9 +45,13 @@ comic_book_exth_values = {
     '547': 'InMemory'
 }
 
+# unless the book says otherwise (see opf_to_oeb)
+DEFAULT_ORIGINAL_RESOLUTION = comic_book_exth_values['original-resolution']
+
 def patch_exth_codes():
     for c in amzn_exth_codes:
-        if EXTH_CODES.has_key(c):
+        # (already patched in batch worker processes)
+        if c in EXTH_CODES and EXTH_CODES[c] != amzn_exth_codes[c]:
             print ('EXTH code already defined: ', c)
         EXTH_CODES[c] = amzn_exth_codes[c]
 
@@ -73,13 +81,13 @@ def fixup_metadata(oeb):
     oeb.metadata.add('subject', 'Comics')
 
         
-def create_kf8_book(oeb, opts, resources):
+# I need to know to text_length without CSS
+class DummyKF8Writer(KF8Writer):
+    def extract_css_into_flows(self):
+        pass
 
-    # I need to know to text_length without CSS
-    class DummyKF8Writer(KF8Writer):
-        def extract_css_into_flows(self):
-            pass
 
+def create_kf8_book(oeb, opts, resources):
     dummy_writer = DummyKF8Writer(oeb, opts, resources)
     writer = KF8Writer(oeb, opts, resources)
     book = KF8Book(writer, for_joint=False)
@@ -106,7 +114,9 @@ def set_cover_image(oeb):
             oeb.metadata.add('cover', cover)
 
 
-def opf_to_book(opf, outpath, container):
+# the OEB book of the OPF, with the comic metadata, and the plumber with the
+# output options
+def opf_to_oeb(opf, outpath, container):
     from calibre.ebooks.conversion.plumber import Plumber, create_oebbook
     class Item(Manifest.Item):
         def _parse_css(self, data):
@@ -119,6 +129,9 @@ def opf_to_book(opf, outpath, container):
     plumber = Plumber(opf, outpath, container.log)
     plumber.setup_options()
 
+    # not the one of the previous book, in batch mode
+    comic_book_exth_values['original-resolution'] = DEFAULT_ORIGINAL_RESOLUTION
+
     class Reader(OEBReader):
         def _metadata_from_opf(self, opf):
             for e in xpath(opf, 'o2:metadata//o2:meta'):
@@ -137,23 +150,37 @@ def opf_to_book(opf, outpath, container):
     plumber.opts.mobi_toc_at_start = False
     plumber.opts.no_inline_toc = True
     plumber.opts.mobi_periodical = False
+    return oeb, plumber
+
+
+def write_kf8_book(book, outpath):
+    book.opts.prefer_author_sort = False
+    book.opts.share_not_sync = False
+    print ('\nWriting out: {}\n'.format(outpath))
+    book.write(outpath)
+
+
+def opf_to_book(opf, outpath, container):
+    oeb, plumber = opf_to_oeb(opf, outpath, container)
 
     res = Resources(oeb, plumber.opts, False, process_images=False)
     
     if path.splitext(outpath)[1] != '.azw3':
         plumber.run()
     else:
-        book = create_kf8_book(oeb, plumber.opts, res)        
-        book.opts.prefer_author_sort = False
-        book.opts.share_not_sync = False
-        print ('\nWriting out: {}\n'.format(outpath))
-        book.write(outpath)
+        book = create_kf8_book(oeb, plumber.opts, res)
+        write_kf8_book(book, outpath)
 
 
-def epub_to_book(epub, outpath=None):
+def epub_container(epub):
     container = get_container(epub, tweak_mode=True)
+    return container, container.name_to_abspath(container.opf_name)
+
+
+def epub_to_book(epub, outpath=None):
+    container, opf = epub_container(epub)
     outpath = outpath or (epub.rpartition('.')[0] + '.azw3')
-    opf_to_book(container.name_to_abspath(container.opf_name), outpath, container)
+    opf_to_book(opf, outpath, container)
 
 
 def extract_mobi(mobi_path, extract_to):
@@ -161,19 +188,118 @@ def extract_mobi(mobi_path, extract_to):
      inspect_mobi(mobi_path, ddir=extract_to)
 
 
-def main(argv=sys.argv):
+def default_output_path(input_path):
+    if path.isdir(input_path):
+        # the staging tree of epub.py: <name>-epub
+        input_path = input_path.rstrip('/')
+        if input_path.endswith('-epub'):
+            input_path = input_path[:-len('-epub')]
+        return input_path + '.azw3'
+    return path.splitext(input_path)[0] + '.azw3'
+
+
+# the books of the batch inputs: EPUB files, epub.py staging trees, and the
+# EPUB files in folders
+def batch_books(inputs):
+    for input_path in inputs:
+        if path.isdir(input_path) and not input_path.rstrip('/').endswith('-epub'):
+            for f in sorted(listdir(input_path)):
+                if path.splitext(f)[1].lower() == '.epub':
+                    yield path.join(input_path, f)
+        else:
+            yield input_path
+
+
+# (output, inputs) of the outputs that several books would be written to,
+# e.g. foo-epub/ and foo.epub
+def output_clashes(books):
+    outputs = {}
+    for book in books:
+        outputs.setdefault(path.realpath(default_output_path(book)), []).append(book)
+    return [(output, inputs) for output, inputs in sorted(outputs.items()) if len(inputs) > 1]
+
 
-    input_path = argv[1]
+# (input, output, seconds, error), for the summary; runs in the worker
+# processes with -j
+def convert_book(input_path):
+    output_path = default_output_path(input_path)
+    start = time.time()
+    error = None
+    try:
+        epub_to_book(input_path, output_path)
+    except Exception as e:
+        traceback.print_exc()
+        error = '{}: {}'.format(type(e).__name__, e)
+    return input_path, output_path, time.time() - start, error
+
+
+# Convert many books in this process (calibre is imported, and the EXTH
+# codes patched, once), or in a pool of jobs processes. Returns the number
+# of books that failed.
+def convert_batch(books, jobs=1):
+    patch_exth_codes()
+    start = time.time()
+    if jobs > 1:
+        # by module name: calibre-debug runs the script in globals of its own,
+        # where the worker processes would not find convert_book
+        script_dir = path.dirname(path.realpath(__file__))
+        if script_dir not in sys.path:
+            sys.path.insert(0, script_dir)
+        import epub_to_azw3_comic as module
+        pool = multiprocessing.Pool(jobs, initializer=module.patch_exth_codes)
+        try:
+            results = pool.map(module.convert_book, books, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        results = [convert_book(i) for i in books]
+
+    print ('\n{:<8} {:>8}  {}'.format('status', 'seconds', 'book'))
+    for input_path, output_path, seconds, error in results:
+        print ('{:<8} {:>8.1f}  {} -> {}'.format('failed' if error else 'ok', seconds, input_path, output_path))
+        if error:
+            print ('{:<8} {:>8}  {}'.format('', '', error))
+    failed = sum(1 for r in results if r[3])
+    print ('{} book(s), {} failed, {:.1f} s'.format(len(results), failed, time.time() - start))
+    return failed
+
+
+def command_line_args(argv):
+    parser = argparse.ArgumentParser(description='EPUB (from epub.py) to AZW3, run with calibre-debug')
+    parser.add_argument('input', nargs='+',
+        help='EPUB file or epub.py staging folder, and the output file; a .mobi file to extract it; '
+             'with --batch, any number of EPUB files, staging folders and folders of EPUB files')
+    parser.add_argument('--batch', action='store_true', help='convert many books, each to <name>.azw3')
+    parser.add_argument('-j', '--jobs', type=int, default=1, help='with --batch, number of worker processes')
+    args = parser.parse_args(argv[1:])
+    if not args.batch and len(args.input) > 2:
+        parser.error('one book at a time, or use --batch')
+    return args
+
+
+def main(argv=sys.argv):
+    args = command_line_args(argv)
+
+    if args.batch:
+        books = list(batch_books(args.input))
+        clashes = output_clashes(books)
+        for output, inputs in clashes:
+            print ('{} would be written by several books: {}'.format(output, ', '.join(inputs)))
+        if clashes:
+            sys.exit(2)
+        if convert_batch(books, args.jobs):
+            sys.exit(1)
+        return
+
+    input_path = args.input[0]
     if input_path.endswith('.mobi'):
         extract_mobi(input_path, path.splitext(input_path)[0] + '_extracted_mobi')
     else:
-        if len(argv) > 2:
-            output_path = argv[2]
+        if len(args.input) > 1:
+            output_path = args.input[1]
         else:
-            if path.isdir(input_path):
-                output_path = input_path.replace('-epub', '.azw3').strip('/')
-            else:
-                output_path = path.splitext(input_path)[0] + '.azw3'
+            output_path = default_output_path(input_path)
 
         patch_exth_codes()
         epub_to_book(input_path, output_path)
@@ -0,0 +1,297 @@
+#! /usr/bin/python3
+#
+# Conversion daemon: keeps the modules imported and a pool of page workers
+# running, and builds books submitted over HTTP on localhost, one at a time,
+# with the same code as epub.py: a book is the same as epub.py makes of it,
+# with any --jobs, apart from the random book id.
+#
+#   POST /jobs            {"input": "/path/to/dir-or.pdf", "output": "/path/to/book.epub",
+#                          "options": ["--shared-css", "-cs", "1072", "1448"]}
+#                         output is optional (default: <name>.epub next to the input),
+#                         options are epub.py command line options
+#   GET  /jobs            all jobs (the last MAX_FINISHED_JOBS finished ones, and the others)
+#   GET  /jobs/ID         state of a job: queued, running, done or failed
+#   GET  /jobs/ID/events  progress: one JSON object per line, as the pages are built,
+#                         until the job is done or failed (the last MAX_JOB_EVENTS)
+#   GET  /status          queue depth, running job, counts
+#
+# e.g. curl -d '{"input": "/comics/issue1"}' localhost:8470/jobs
+#      curl -N localhost:8470/jobs/1/events
+#
+import argparse
+import json
+import multiprocessing
+import os
+import queue
+import threading
+import time
+from collections import Counter, deque
+from concurrent.futures.process import BrokenProcessPool
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from itertools import count, islice
+from os import makedirs, path
+
+import profiling
+from epub import Book, command_line_args, pushd, worker_pool
+
+DEFAULT_PORT = 8470
+# events kept per job: a client that falls further behind misses the oldest
+MAX_JOB_EVENTS = 10000
+# finished jobs kept, for GET /jobs
+MAX_FINISHED_JOBS = 100
+
+
+class JobArgumentParser(argparse.ArgumentParser):
+    # report bad options to the client, instead of exiting
+    def error(self, message):
+        raise ValueError(message)
+
+    def exit(self, status=0, message=None):
+        raise ValueError(message or 'invalid options')
+
+
+class Job:
+    def __init__(self, id, input, output, options):
+        self.id = id
+        self.input = input
+        self.output = output
+        self.options = options
+        self.state = 'queued'
+        self.error = None
+        self.submitted = time.time()
+        self.started = self.finished = None
+        self.pages = 0
+        self.events = deque(maxlen=MAX_JOB_EVENTS)
+        # events added, including the ones dropped from events
+        self.event_count = 0
+        self.changed = threading.Condition()
+
+    def add_event(self, event):
+        with self.changed:
+            self.events.append(event)
+            self.event_count += 1
+            self.changed.notify_all()
+
+    # the final state and event at once: a client that sees the one sees the other
+    def finish(self, state, error=None):
+        with self.changed:
+            self.state, self.error = state, error
+            self.finished = time.time()
+            self.add_event({'event': state, 'error': error, 'pages': self.pages, 'seconds': self.finished - self.started})
+
+    def info(self):
+        return {
+            'id': self.id,
+            'input': self.input,
+            'output': self.output,
+            'options': self.options,
+            'state': self.state,
+            'error': self.error,
+            'submitted': self.submitted,
+            'started': self.started,
+            'finished': self.finished,
+            'pages': self.pages,
+        }
+
+
+class Daemon:
+    def __init__(self, jobs):
+        self.jobs = jobs
+        self.all_jobs = {}
+        self.queue = queue.Queue()
+        self.running = None
+        self.ids = count(1)
+        self.lock = threading.Lock()
+        self.started = time.time()
+        # done and failed jobs, including the ones dropped from all_jobs
+        self.counts = Counter()
+        self.start_workers()
+        profiling.subscribe(self.on_record)
+
+    # The workers are forked from a server process started with the first
+    # pool, before the daemon listens: a pool started later (see workers())
+    # would otherwise hold on to the listening socket, after the daemon too.
+    def start_workers(self):
+        self.executor = worker_pool(argparse.Namespace(jobs=self.jobs), multiprocessing.get_context('forkserver'))
+        # start the workers now rather than with the first job
+        list(self.executor.map(abs, range(self.jobs)))
+
+    # the pool, a new one if a worker died (killed, out of memory) since the
+    # last job: a broken pool takes no more work
+    def workers(self):
+        try:
+            self.executor.submit(abs, 0).result()
+        except BrokenProcessPool:
+            self.executor.shutdown(wait=False)
+            self.start_workers()
+        return self.executor
+
+    # validate and queue a job
+    def submit(self, request):
+        input = request.get('input')
+        options = request.get('options', [])
+        if not isinstance(input, str) or not path.isabs(input):
+            raise ValueError('input must be an absolute path')
+        if not isinstance(options, list) or not all(isinstance(i, str) for i in options):
+            raise ValueError('options must be a list of strings')
+        args = command_line_args([input] + options, JobArgumentParser)
+        if len(args.inputs) != 1:
+            raise ValueError('one book per job')
+        if args.cover and not path.isabs(args.cover):
+            raise ValueError('cover must be an absolute path')
+        output = request.get('output') or path.join(path.dirname(input.rstrip('/')), Book(args, input).output)
+        if not path.isabs(output):
+            raise ValueError('output must be an absolute path')
+        # the pages are built by the daemon's workers
+        args.jobs = self.jobs
+
+        with self.lock:
+            job = Job(next(self.ids), input, output, options)
+            job.args = args
+            self.all_jobs[job.id] = job
+        self.queue.put(job)
+        return job
+
+    def run(self):
+        while True:
+            job = self.queue.get()
+            self.running = job
+            job.state = 'running'
+            job.started = time.time()
+            job.add_event({'event': 'started'})
+            try:
+                makedirs(path.dirname(job.output), exist_ok=True)
+                Book(job.args, job.input, job.output).build(self.workers())
+            except Exception as e:
+                job.finish('failed', '{}: {}'.format(type(e).__name__, e))
+            else:
+                job.finish('done')
+            self.running = None
+            self.forget_finished(job)
+
+    def forget_finished(self, job):
+        with self.lock:
+            self.counts[job.state] += 1
+            finished = [i for i in self.all_jobs.values() if i.state in ['done', 'failed']]
+            for i in finished[:-MAX_FINISHED_JOBS]:
+                del self.all_jobs[i.id]
+
+    def job_list(self):
+        with self.lock:
+            return list(self.all_jobs.values())
+
+    # stage timings of the running book (see profiling.py), as progress events
+    def on_record(self, record):
+        job = self.running
+        if job:
+            if record['stage'] == 'html':
+                job.pages += 1
+            job.add_event(dict(record, event='stage', pages=job.pages))
+
+    def status(self):
+        return {
+            'queued': self.queue.qsize(),
+            'running': self.running.id if self.running else None,
+            'done': self.counts['done'],
+            'failed': self.counts['failed'],
+            'workers': self.jobs,
+            'uptime': time.time() - self.started,
+        }
+
+
+class Handler(BaseHTTPRequestHandler):
+    daemon = None
+
+    def send_json(self, code, value):
+        body = json.dumps(value).encode('utf-8')
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def job(self, id):
+        try:
+            return self.daemon.all_jobs.get(int(id))
+        except ValueError:
+            return None
+
+    def do_GET(self):
+        parts = self.path.strip('/').split('/')
+        if parts == ['status']:
+            self.send_json(200, self.daemon.status())
+        elif parts == ['jobs']:
+            self.send_json(200, [job.info() for job in self.daemon.job_list()])
+        elif len(parts) in [2, 3] and parts[0] == 'jobs' and self.job(parts[1]):
+            job = self.job(parts[1])
+            if len(parts) == 2:
+                self.send_json(200, job.info())
+            elif parts[2] == 'events':
+                self.stream_events(job)
+            else:
+                self.send_json(404, {'error': 'not found'})
+        else:
+            self.send_json(404, {'error': 'not found'})
+
+    def do_POST(self):
+        if self.path.strip('/') != 'jobs':
+            return self.send_json(404, {'error': 'not found'})
+        try:
+            request = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+            if not isinstance(request, dict):
+                raise ValueError('expected a JSON object')
+            job = self.daemon.submit(request)
+        except Exception as e:
+            return self.send_json(400, {'error': str(e)})
+        self.send_json(202, job.info())
+
+    # one JSON object per line, until the job is over (the connection closes)
+    def stream_events(self, job):
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/x-ndjson')
+        self.end_headers()
+        # events sent, or dropped before they could be (see MAX_JOB_EVENTS)
+        sent = 0
+        while True:
+            with job.changed:
+                job.changed.wait_for(lambda: job.event_count > sent or job.state in ['done', 'failed'], timeout=30)
+                dropped = job.event_count - len(job.events)
+                events = list(islice(job.events, max(sent - dropped, 0), None))
+                sent = job.event_count
+                # (the final event is added with the state, see Job.finish)
+                over = job.state in ['done', 'failed']
+            for event in events:
+                self.wfile.write(json.dumps(event).encode('utf-8') + b'\n')
+            self.wfile.flush()
+            if over:
+                break
+
+
+def command_line():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--host', default='127.0.0.1', help='address to listen on (default: %(default)s)')
+    parser.add_argument('--port', type=int, default=DEFAULT_PORT)
+    parser.add_argument('-j', '--jobs', type=int, default=0, help='number of worker processes (0: one per CPU)')
+    return parser.parse_args()
+
+
+def main():
+    args = command_line()
+    daemon = Daemon(args.jobs or os.cpu_count())
+    Handler.daemon = daemon
+    threading.Thread(target=daemon.run, daemon=True).start()
+    server = ThreadingHTTPServer((args.host, args.port), Handler)
+    print ('Listening on {}:{}, {} worker(s)'.format(args.host, args.port, daemon.jobs))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        daemon.executor.shutdown(cancel_futures=True)
+
+
+if __name__ == '__main__':
+    # epub.py reads its resources (META-INF, css, script) relative to its folder
+    with pushd(path.dirname(__file__)):
+        main()
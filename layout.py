@@ -0,0 +1,111 @@
+#
+# Panel geometry as a NumPy structured array, one row per panel: the panel
+# rectangle in image pixels, and the CSS numbers of its region and
+# magnification target, computed for all the panels at once.
+#
+# The numbers are left unrounded. Serialization rounds them with Python's
+# round() (not np.round, which can round differently), and the arithmetic is
+# done in the same order as the scalar code it replaced, so the CSS comes
+# out the same to the last digit.
+#
+import json
+
+import numpy as np
+
+MAX_SCALE_FACTOR = 0.98
+
+PANEL_DTYPE = np.dtype([
+    ('page', 'i4'),         # index of the page in the book (page-N)
+    ('ordinal', 'i4'),      # 1, 2, ... in reading order
+    ('x', 'i4'), ('y', 'i4'), ('w', 'i4'), ('h', 'i4'),
+    ('image_width', 'i4'), ('image_height', 'i4'),
+    ('scale', 'f8'),        # magnification
+    # region, in percent of the page image
+    ('left', 'f8'), ('top', 'f8'), ('width', 'f8'), ('height', 'f8'),
+    # magnification target box, in percent of the client size
+    ('mag_left', 'f8'), ('mag_top', 'f8'), ('mag_width', 'f8'), ('mag_height', 'f8'),
+    # magnified image: offset in percent, size in pixels
+    ('img_left', 'f8'), ('img_top', 'f8'), ('img_width', 'i4'), ('img_height', 'i4'),
+])
+
+
+# rects: (x, y, w, h) of the panels of one page, in reading order
+def panel_layout(rects, img_size, client_size, page=-1):
+    table = np.zeros(len(rects), PANEL_DTYPE)
+    if not len(rects):
+        return table
+    rects = np.array(rects, dtype=np.int64).reshape(-1, 4)
+    x, y, w, h = rects.T
+    W, H = img_size
+    cw, ch = client_size
+
+    table['page'] = page
+    table['ordinal'] = np.arange(1, len(table) + 1)
+    table['x'], table['y'], table['w'], table['h'] = x, y, w, h
+    table['image_width'], table['image_height'] = W, H
+
+    scale = np.minimum(MAX_SCALE_FACTOR * cw / w, MAX_SCALE_FACTOR * ch / h)
+    table['scale'] = scale
+
+    table['left'] = x*100./W
+    table['top'] = y*100./H
+    table['width'] = w*100./W
+    table['height'] = h*100./H
+
+    # centered
+    table['mag_left'] = MAX_SCALE_FACTOR*50*(cw-w*scale)/cw
+    table['mag_top'] = 50*(ch-h*scale)/ch
+    table['mag_width'] = 100*w*scale/cw
+    table['mag_height'] = 100*h*scale/ch
+
+    table['img_top'] = -y*100/h
+    table['img_left'] = -x*100/w
+    # (truncated, like int())
+    table['img_width'] = W*scale
+    table['img_height'] = H*scale
+    return table
+
+
+# Factor to shrink a page by so that it has no more pixels than the device
+# shows: the whole page stretched over the client size, and the most
+# magnified of its panels. Never more than 1 (no upscaling).
+def output_factor(table, img_size, client_size):
+    W, H = img_size
+    cw, ch = client_size
+    fit = max(cw / W, ch / H)
+    zoom = table['scale'].max() if len(table) else 0
+    return min(1.0, max(fit, zoom))
+
+
+def percent(v):
+    return '{}%'.format(round(v, 2))
+
+
+# CSS declarations of each panel: (ordinal, region, magnification box, magnified image)
+def css_declarations(table):
+    names = table.dtype.names
+    for row in table.tolist():
+        p = dict(zip(names, row))
+        region = [(i, percent(p[i])) for i in ['top', 'left', 'height', 'width']]
+        target = [(i, percent(p['mag_' + i])) for i in ['top', 'left', 'height', 'width']]
+        img = [
+            ('top', percent(p['img_top'])),
+            ('left', percent(p['img_left'])),
+            ('width', '{}px'.format(p['img_width'])),
+            ('height', '{}px'.format(p['img_height'])),
+        ]
+        yield p['ordinal'], region, target, img
+
+
+# The panels of a book, for other tools: .npz (the array as is, and the
+# client size), or JSON otherwise (field names, and one list per panel).
+def save_layout(filename, table, client_size):
+    if filename.lower().endswith('.npz'):
+        np.savez_compressed(filename, panels=table, client_size=np.array(client_size))
+    else:
+        with open(filename, 'w') as f:
+            json.dump({
+                'client_size': list(client_size),
+                'fields': list(table.dtype.names),
+                'panels': table.tolist(),
+            }, f)
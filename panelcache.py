@@ -0,0 +1,102 @@
+#
+# Persistent panel detection cache, so that re-building a book (to change the
+# title, client size, JPEG quality, etc.) does not run OpenCV on unchanged pages.
+#
+# Entries are keyed by a hash of the image file contents plus the detection
+# params, and evicted least recently used first.
+#
+import hashlib
+import json
+import sqlite3
+import time
+from os import makedirs, path
+
+DEFAULT_CACHE = path.join(path.expanduser('~'), '.cache', 'epub-comics', 'panels.sqlite')
+DEFAULT_MAX_ENTRIES = 100000
+EVICT_FRACTION = 0.1
+
+
+class PanelCache:
+    def __init__(self, filename=DEFAULT_CACHE, max_entries=DEFAULT_MAX_ENTRIES):
+        if path.dirname(filename):
+            makedirs(path.dirname(filename), exist_ok=True)
+        self.filename = filename
+        self.max_entries = max_entries
+        # set on the first error reading or writing the cache, it is not used after that
+        self.failed = False
+        # worker processes share the database file, wait on each other's locks
+        self.db = sqlite3.connect(filename, timeout=60, isolation_level=None)
+        self.db.execute('CREATE TABLE IF NOT EXISTS panels (key TEXT PRIMARY KEY, value TEXT, used REAL)')
+        self.db.execute('CREATE INDEX IF NOT EXISTS panels_used ON panels (used)')
+        # entries as of the last count, plus the puts since (other processes put
+        # too, and a put may replace an entry: recounted before evicting)
+        self.count = self._count()
+
+    def get(self, key):
+        if self.failed:
+            return None
+        try:
+            row = self.db.execute('SELECT value FROM panels WHERE key=?', (key,)).fetchone()
+            if row is None:
+                return None
+            self.db.execute('UPDATE panels SET used=? WHERE key=?', (time.time(), key))
+        except sqlite3.Error as e:
+            # (a read-only database, a full disk...)
+            self._fail(e)
+            return None
+        return json.loads(row[0])
+
+    def put(self, key, value):
+        if self.failed:
+            return
+        try:
+            self.db.execute('INSERT OR REPLACE INTO panels VALUES (?, ?, ?)', (key, json.dumps(value), time.time()))
+            self.count += 1
+            if self.count > self.max_entries:
+                self._evict()
+        except sqlite3.Error as e:
+            self._fail(e)
+
+    def _fail(self, e):
+        warn_unusable(self.filename, e)
+        self.failed = True
+
+    # down to EVICT_FRACTION below max_entries, so that it is not done on every put
+    def _evict(self):
+        self.count = self._count()
+        if self.count > self.max_entries:
+            keep = int(self.max_entries * (1 - EVICT_FRACTION))
+            self.db.execute('DELETE FROM panels WHERE key IN (SELECT key FROM panels ORDER BY used ASC LIMIT ?)',
+                (self.count - keep,))
+            self.count = keep
+
+    def _count(self):
+        return self.db.execute('SELECT count(*) FROM panels').fetchone()[0]
+
+    def close(self):
+        self.db.close()
+
+
+def cache_key(data, params):
+    h = hashlib.sha256(data)
+    h.update(json.dumps(params, sort_keys=True).encode('utf-8'))
+    return h.hexdigest()
+
+
+def warn_unusable(filename, e):
+    print ('Panel cache {} not used: {}'.format(filename, e))
+
+
+# One connection per process (the page pipeline may run in worker processes).
+# The cache is only an optimization: None, after a warning, if it cannot be
+# opened (its folder cannot be made, HOME is read-only...).
+_caches = {}
+
+def open_cache(filename, max_entries=DEFAULT_MAX_ENTRIES):
+    if filename not in _caches:
+        try:
+            _caches[filename] = PanelCache(filename, max_entries)
+        except (OSError, sqlite3.Error) as e:
+            warn_unusable(filename, e)
+            _caches[filename] = None
+    return _caches[filename]
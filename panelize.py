@@ -2,10 +2,12 @@
 #! /usr/bin/python3
 import cv2
 import itertools
+import math
 import os
 import sys
 import numpy as np
 #import time
+from collections import defaultdict
 from PIL import Image, ImageDraw, JpegImagePlugin, UnidentifiedImageError
 
 def split_across(t, r, im, xy):
@@ -43,23 +45,106 @@ def split(threshold, rects, im, xy=[0,0]):
     return rects
 
 
-def auto_threshold(img, threshold=None):
-    last = 0 if threshold is None else threshold
+THRESHOLD_METHODS = ['auto', 'otsu', 'triangle']
+
+
+# pixels per cv2.calcHist call: its float32 counts are exact up to 2**24
+HISTOGRAM_BAND_PIXELS = 1 << 24
+
 
-    for t in range(last+1, 256):
-        _, img2 = cv2.threshold(img, t, 255, cv2.THRESH_BINARY)
-        t2 = np.mean(img2)
-        #print (t,t2)
-        if 125 <= t2 <= 127:
-            return t, img2
+def histogram(img):
+    # one pass over the pixels, no copy of them; bands of rows keep the
+    # counts exact, they are summed as integers
+    rows = max(1, HISTOGRAM_BAND_PIXELS // img.shape[1])
+    hist = np.zeros(256, np.int64)
+    for y in range(0, img.shape[0], rows):
+        hist += cv2.calcHist([img[y:y + rows]], [0], None, [256], [0, 256]).ravel().astype(np.int64)
+    return hist
 
-    for t in range(last, -1, -1):
-        _, img2 = cv2.threshold(img, t, 255, cv2.THRESH_BINARY)
-        t2 = np.mean(img2)      
-        #print (t,t2)
-        if 125 <= t2 <= 127:
-            return t, img2
-    return last, img2
+
+def balance_threshold(hist, threshold=None):
+    # Find the threshold that brings the mean of the binarized image closest
+    # to mid-gray, searching up from the last threshold first, then down.
+    # Pixels above t go to 255, so the mean is 255 * count(> t) / count.
+    last = 0 if threshold is None else threshold
+    count = hist.sum()
+    mean = 255.0 * (count - np.cumsum(hist)) / count
+    ok = (mean >= 125) & (mean <= 127)
+    t = np.arange(256)
+
+    up = np.nonzero(ok & (t > last))[0]
+    if len(up):
+        return int(up[0])
+    down = np.nonzero(ok & (t <= last))[0]
+    if len(down):
+        return int(down[-1])
+    return last
+
+
+# port of OpenCV's getThreshVal_Otsu_8u, so results match cv2.THRESH_OTSU
+def otsu_threshold(hist):
+    scale = 1. / hist.sum()
+    mu = sum(i * float(h) for i, h in enumerate(hist)) * scale
+    mu1 = q1 = 0.
+    max_sigma = max_val = 0
+    eps = np.finfo(np.float32).eps
+    for i, h in enumerate(hist):
+        p_i = h * scale
+        mu1 *= q1
+        q1 += p_i
+        q2 = 1. - q1
+        if min(q1, q2) < eps or max(q1, q2) > 1. - eps:
+            continue
+        mu1 = (mu1 + i * p_i) / q1
+        mu2 = (mu - q1 * mu1) / q2
+        sigma = q1 * q2 * (mu1 - mu2) * (mu1 - mu2)
+        if sigma > max_sigma:
+            max_sigma, max_val = sigma, i
+    return max_val
+
+
+# port of OpenCV's getThreshVal_Triangle_8u, so results match cv2.THRESH_TRIANGLE
+def triangle_threshold(hist):
+    h = [int(i) for i in hist]
+    N = len(h)
+    nonzero = [i for i in range(N) if h[i] > 0]
+    left_bound, right_bound = (nonzero[0], nonzero[-1]) if nonzero else (0, 0)
+    if left_bound > 0:
+        left_bound -= 1
+    if right_bound < N - 1:
+        right_bound += 1
+    max_ind = h.index(max(h))
+
+    flipped = max_ind - left_bound < right_bound - max_ind
+    if flipped:
+        h.reverse()
+        left_bound = N - 1 - right_bound
+        max_ind = N - 1 - max_ind
+
+    thresh, dist = left_bound, 0
+    a, b = h[max_ind], left_bound - max_ind
+    for i in range(left_bound + 1, max_ind + 1):
+        tempdist = a * i + b * h[i]
+        if tempdist > dist:
+            dist, thresh = tempdist, i
+    thresh -= 1
+
+    if flipped:
+        thresh = N - 1 - thresh
+    return thresh
+
+
+def auto_threshold(img, threshold=None, method='auto', binarize=True):
+    hist = histogram(img)
+    if method == 'otsu':
+        t = otsu_threshold(hist)
+    elif method == 'triangle':
+        t = triangle_threshold(hist)
+    else:
+        t = balance_threshold(hist, threshold)
+    # the binarized image is only computed if asked for
+    img2 = cv2.threshold(img, t, 255, cv2.THRESH_BINARY)[1] if binarize else None
+    return t, img2
 
 
 def panelize_crop(im, threshold):
@@ -108,71 +193,78 @@ def intersection(a,b):
 #     #print ('merge({}): {}, {:.5f}'.format(num_rects, len(rects), time.time() - start))
 #     return rects
 
-class Rect:
-    def __init__(self,r):
-        self.r = r
-        self.connected = set()
-        self.group = None
-
-def visit_rect(rects, i, group, depth=1):
-    r = rects[i]
-    if r.group is None:
-        #print ('{:{}}{} [{}]'.format('', 2*depth, i, group))
-        r.group = group
-        for j in r.connected:
-            visit_rect(rects, j, group, depth+1)
-    else:
-        assert r.group==group or depth==1, (r.group, group, i)
+def overlapping_pairs(boxes):
+    # Uniform grid spatial index: yield each pair of (x1,y1,x2,y2) boxes that
+    # intersect or touch exactly once, without comparing every pair. A pair is
+    # only reported in the cell holding the top-left corner of the intersection.
+    if not boxes:
+        return
+    sizes = sorted(max(x2-x1, y2-y1) for (x1,y1,x2,y2) in boxes)
+    extent = max(max(b[2] for b in boxes) - min(b[0] for b in boxes),
+                 max(b[3] for b in boxes) - min(b[1] for b in boxes))
+    # about twice the typical box, but no more than 256 cells across
+    cell = max(16, 2 * sizes[len(sizes)//2], extent // 256)
+
+    grid = defaultdict(list)
+    for i, (x1,y1,x2,y2) in enumerate(boxes):
+        for cx in range(x1//cell, x2//cell + 1):
+            for cy in range(y1//cell, y2//cell + 1):
+                grid[cx, cy].append(i)
+
+    for (cx, cy), members in grid.items():
+        for k, i in enumerate(members):
+            x1,y1,x2,y2 = boxes[i]
+            for j in members[k+1:]:
+                _x1,_y1,_x2,_y2 = boxes[j]
+                left, top = max(x1,_x1), max(y1,_y1)
+                if left <= min(x2,_x2) and top <= min(y2,_y2) and left//cell == cx and top//cell == cy:
+                    yield i, j
 
-def connect(rects, i, j):
-    assert i != j
-    rects[i].connected.add(j)
-    rects[j].connected.add(i)
 
 def merge(areas):
     #start = time.time()
-    rects = []
-    for r in areas:
-        rects.append(Rect(r))
-    num_rects = len(rects)
-    for i in range(0, num_rects):
-        for j in range(i+1, num_rects):
-            a = rects[i]
-            b = rects[j]
-            if intersection(a.r, b.r):
-                connect(rects, i, j)
-    for i, r in enumerate(rects):
-        #print ('--- {} ---'.format(i))
-        visit_rect(rects, i, i)
-    #return [i.r for i in rects]
+    boxes = [(x, y, x+w, y+h) for (x,y,w,h) in areas]
+    num_rects = len(boxes)
+
+    # union-find, the root of a group is its lowest index
+    parent = list(range(num_rects))
+    def find(i):
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    # group intersecting (or touching) rectangles
+    for i, j in overlapping_pairs(boxes):
+        a, b = find(i), find(j)
+        if a != b:
+            parent[max(a, b)] = min(a, b)
+
     union = {}
-    for r in rects:
-        x,y,w,h = r.r
-        x1,y1,x2,y2 = union.setdefault(r.group, (x,y,x+w,y+h))
-        if x<x1:
-            x1=x
-        if y<y1:
-            y1=y
-        if x+w>x2:
-            x2=x+w
-        if y+h>y2:
-            y2=y+h
-        union[r.group]=(x1,y1,x2,y2)
-
-    items = union.items()
+    for i, (x,y,x2,y2) in enumerate(boxes):
+        group = find(i)
+        if group in union:
+            x1,y1,_x2,_y2 = union[group]
+            union[group] = (min(x,x1), min(y,y1), max(x2,_x2), max(y2,_y2))
+        else:
+            union[group] = (x,y,x2,y2)
+
+    # drop groups contained in other groups
+    groups = list(union.keys())
+    items = list(union.values())
     delete = set()
-    for k,(x1,y1,x2,y2) in items:
-        for j,(_x1,_y1,_x2,_y2) in items:
-            if j==k:
-                continue
-            if x1 >= _x1 and y1 >= _y1 and x2 <= _x2 and y2 <= _y2:
-                delete.add(k)
+    for i, j in overlapping_pairs(items):
+        (x1,y1,x2,y2), (_x1,_y1,_x2,_y2) = items[i], items[j]
+        if x1 >= _x1 and y1 >= _y1 and x2 <= _x2 and y2 <= _y2:
+            delete.add(groups[i])
+        if _x1 >= x1 and _y1 >= y1 and _x2 <= x2 and _y2 <= y2:
+            delete.add(groups[j])
 
     for k in delete:
         del union[k]
 
     #print ('merge_rects({}): {}, {:.5f}'.format(num_rects, len(union), time.time() - start))    
-    return [(x1,y1,x2-x1,y2-y1) for _,(x1,y1,x2,y2) in items]
+    return [(x1,y1,x2-x1,y2-y1) for _,(x1,y1,x2,y2) in union.items()]
 
 
 def panelize_contours(img, threshold, kern_size=2, iterations=1):
@@ -203,6 +295,33 @@ def panelize_contours(img, threshold, kern_size=2, iterations=1):
     return rects, kern_size, iterations
 
 
+def downscale(img, height):
+    # Panel borders are large structures, detect them on a smaller proxy image.
+    # Returns the proxy, and the factor for scaling the rectangles back up.
+    # An integer factor keeps the proxy at least as tall as asked for, and
+    # takes OpenCV's fast path for INTER_AREA.
+    h, w = img.shape[:2]
+    factor = h // height if height else 1
+    if factor <= 1:
+        return img, 1.0
+    # crop (a view, not a copy) to a multiple of the factor, same reason
+    w, h = max(1, w // factor), h // factor
+    img = img[:h * factor, :w * factor]
+    return cv2.resize(img, (w, h), interpolation=cv2.INTER_AREA), float(factor)
+
+
+def upscale_rects(rects, factor, size):
+    if factor == 1.0:
+        return rects
+    W, H = size
+    result = []
+    for (x,y,w,h) in rects:
+        x1, y1 = int(x*factor), int(y*factor)
+        x2, y2 = min(W, math.ceil((x+w)*factor)), min(H, math.ceil((y+h)*factor))
+        result.append((x1, y1, x2-x1, y2-y1))
+    return result
+
+
 def sort_panels(img, panels, grid=10):
     min_w = img.shape[1]//grid
     min_h = img.shape[0]//grid
@@ -212,10 +331,10 @@ def sort_panels(img, panels, grid=10):
 
 
 def image_to_array(img):
-    img = np.array(img)
-    if len(img.shape) > 2:
-        img = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)    
-    return img
+    # let PIL convert to grayscale (luma), a single plane is all that gets copied
+    if img.mode != 'L':
+        img = img.convert('L')
+    return np.array(img)
 
 
 def change_resolution(page, paper_format=None, dpi=300, format=False):
@@ -324,7 +443,7 @@ def test_panelize(files, out_dir):
 
         im = image_to_array(img)
 
-        threshold, _ = auto_threshold(im, threshold)
+        threshold, _ = auto_threshold(im, threshold, binarize=False)
         print ('auto threshold:', threshold)
 
         use_countours_method = True
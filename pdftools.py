@@ -1,10 +1,24 @@
+import argparse
 import PyPDF2
+import os
 import warnings
 import sys
+from codec import encode
+from concurrent.futures import ProcessPoolExecutor
 from io import BytesIO
-from os import path
+from itertools import repeat
+from os import makedirs, path
 from PIL import Image, JpegImagePlugin
 
+# image streams that are complete image files as stored in the PDF
+RAW_EXTENSIONS = {'/DCTDecode': '.jpg', '/JPXDecode': '.jp2'}
+
+
+# File name (without extension) of the k-th image of a page, which does not
+# depend on how the pages are split between workers.
+def image_name(pageNum, k):
+    return 'page-{:05d}'.format(pageNum) + ('-{}'.format(k) if k else '')
+
 
 class ImageExtractor:
     def __init__(self, filename):
@@ -18,26 +32,49 @@ class ImageExtractor:
         self.file = PyPDF2.PdfFileReader(open(self.filename, 'rb'))
         return self
 
-    def __exit__(self, exType, exValue, backtrace):        
+    def __exit__(self, exType, exValue, backtrace):
         self.file = None
         self.catch_warnings.__exit__(exType, exValue, backtrace)
 
-    def _extract(self, pageNum: int, page):
+    def _extract(self, pageNum: int, page, raw):
         xObject = page['/Resources']['/XObject'].getObject()
-        
-        for obj in xObject:            
+
+        for obj in xObject:
             obj = xObject[obj]
             if obj['/Subtype'] != '/Image':
-                continue            
+                continue
             filter = obj['/Filter']
             assert filter in [ '/FlateDecode', '/DCTDecode', '/JPXDecode'], filter
-            img = Image.open(BytesIO(obj._data))
-            self.images.append(img)
+            if raw and filter in RAW_EXTENSIONS:
+                # the encoded stream, as is
+                yield obj._data, RAW_EXTENSIONS[filter]
+            else:
+                yield Image.open(BytesIO(obj._data)), None
+
+    def num_pages(self):
+        return self.file.getNumPages()
+
+    # Yield (page number, image) one page at a time, so that only the images
+    # of the current page are held in memory. With raw=True, JPEG and JPEG 2000
+    # images are not decoded: they come as (page number, (bytes, extension)).
+    # start, stop: range of pages to extract
+    def iter_images(self, raw=False, start=0, stop=None):
+        numPages = self.num_pages() if stop is None else min(stop, self.num_pages())
+        for i in range(start, numPages):
+            for img, ext in self._extract(i, self.file.getPage(i), raw):
+                yield i, (img, ext) if ext else img
+
+    # same as iter_images, with image_name(page number, index in page)
+    def iter_named_images(self, raw=False, start=0, stop=None):
+        page, k = None, 0
+        for i, img in self.iter_images(raw, start, stop):
+            k = k + 1 if i == page else 0
+            page = i
+            yield image_name(i, k), img
 
     def run(self):
-        numPages = self.file.getNumPages()
-        for i in range(0, numPages):
-            self._extract(i, self.file.getPage(i))
+        for _, img in self.iter_images():
+            self.images.append(img)
 
 
 def save_image(img, fname):
@@ -45,20 +82,64 @@ def save_image(img, fname):
     quantization = getattr(img, 'quantization', None)
     subsampling = JpegImagePlugin.get_sampling(img) if quantization else None
     if subsampling:
-        img.save(fname, subsampling=subsampling, qtables=quantization)
+        data = encode(img, qtables=quantization, subsampling=subsampling)
     else:
-        img.save(fname)
+        data = encode(img)
+    with open(fname, 'wb') as f:
+        f.write(data)
 
 
-if __name__ == '__main__': 
-    if (len(sys.argv) < 2):
-        print("\nUsage: python {} input_file\n".format(sys.argv[0]))
-        quit()
-    
-    filename = sys.argv[1]
+def save_raw(data, fname):
+    print (fname)
+    with open(fname, 'wb') as f:
+        f.write(data)
+
+
+# Save the images of a range of pages to output_dir, return how many.
+def extract(filename, output_dir, raw=False, start=0, stop=None):
+    count = 0
     with ImageExtractor(filename) as extractor:
-        extractor.run()
-        print ('Extracted {} images'.format(len(extractor.images)))
-                        
-        for i, img in enumerate(extractor.images):
-            save_image(img, 'page-{:05d}.jpg'.format(i))
+        for name, img in extractor.iter_named_images(raw, start, stop):
+            fname = path.join(output_dir, name)
+            if isinstance(img, tuple):
+                data, ext = img
+                save_raw(data, fname + ext)
+            else:
+                save_image(img, fname + '.jpg')
+            count += 1
+    return count
+
+
+# Same as extract, with the pages split in ranges between worker processes,
+# each worker opens the PDF on its own.
+def extract_parallel(filename, output_dir, raw=False, jobs=None):
+    jobs = jobs or os.cpu_count()
+    with ImageExtractor(filename) as extractor:
+        numPages = extractor.num_pages()
+    # one range per worker: each worker opening (and indexing) the PDF costs
+    # more than the imbalance between ranges of similar pages
+    size = max(1, -(-numPages // jobs))
+    ranges = range(0, numPages, size)
+    with ProcessPoolExecutor(jobs) as executor:
+        counts = executor.map(extract, repeat(filename), repeat(output_dir), repeat(raw), ranges, [i + size for i in ranges])
+        return sum(counts)
+
+
+def command_line_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('input_file')
+    parser.add_argument('-o', '--output-dir', default='.')
+    parser.add_argument('--raw', action='store_true', help='write JPEG / JPEG 2000 streams out as is, without decoding')
+    parser.add_argument('-j', '--jobs', type=int, default=1, help='worker processes, 0 to use all CPUs')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = command_line_args()
+    makedirs(args.output_dir, exist_ok=True)
+
+    if args.jobs == 1:
+        count = extract(args.input_file, args.output_dir, args.raw)
+    else:
+        count = extract_parallel(args.input_file, args.output_dir, args.raw, args.jobs)
+    print ('Extracted {} images'.format(count))
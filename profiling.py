@@ -0,0 +1,101 @@
+#
+# Build instrumentation: wall and CPU time of each stage of each page, and
+# the peak RSS of the process that ran it.
+#
+# Stages that run in the page pipeline are timed into a plain list kept with
+# the page, so that timings taken in worker processes travel back with it.
+# The main process collects everything in a Profiler, which calls the
+# subscribed callbacks (see subscribe) with each record as it comes in.
+#
+import contextlib
+import csv
+import json
+import os
+import resource
+import sys
+import time
+
+RECORD_FIELDS = ['book', 'stage', 'page', 'wall', 'cpu', 'peak_rss', 'pid']
+
+_subscribers = []
+
+
+# callback(record) for every record collected by any Profiler, e.g. for
+# feeding a dashboard; record is a dict with the RECORD_FIELDS keys
+def subscribe(callback):
+    _subscribers.append(callback)
+
+
+def unsubscribe(callback):
+    _subscribers.remove(callback)
+
+
+# in bytes
+def peak_rss():
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes, except on macOS
+    return rss if sys.platform == 'darwin' else rss * 1024
+
+
+@contextlib.contextmanager
+def timed(records, stage, page=None):
+    wall, cpu = time.perf_counter(), time.process_time()
+    try:
+        yield
+    finally:
+        records.append({
+            'stage': stage,
+            'page': page,
+            'wall': time.perf_counter() - wall,
+            'cpu': time.process_time() - cpu,
+            'peak_rss': peak_rss(),
+            'pid': os.getpid(),
+        })
+
+
+# book: the name of the book the records are for, if any
+class Profiler:
+    def __init__(self, book=None):
+        self.book = book
+        self.records = []
+
+    def append(self, record):
+        record['book'] = self.book
+        self.records.append(record)
+        for callback in list(_subscribers):
+            callback(record)
+
+    def extend(self, records):
+        for record in records:
+            self.append(record)
+
+    def stage(self, stage, page=None):
+        return timed(self, stage, page)
+
+    # totals by stage, in the order the stages first ran
+    def summary(self):
+        stages = {}
+        for r in self.records:
+            s = stages.setdefault(r['stage'], {'count': 0, 'wall': 0.0, 'cpu': 0.0, 'peak_rss': 0})
+            s['count'] += 1
+            s['wall'] += r['wall']
+            s['cpu'] += r['cpu']
+            s['peak_rss'] = max(s['peak_rss'], r['peak_rss'])
+        return stages
+
+    def print_summary(self):
+        print ('{:<12} {:>6} {:>10} {:>10} {:>10}'.format('stage', 'count', 'wall (s)', 'cpu (s)', 'peak MB'))
+        for stage, s in self.summary().items():
+            print ('{:<12} {:>6} {:>10.3f} {:>10.3f} {:>10.1f}'.format(
+                stage, s['count'], s['wall'], s['cpu'], s['peak_rss'] / 2**20))
+
+    # CSV if the file name ends in .csv, JSON otherwise
+    def save(self, filename):
+        if filename.lower().endswith('.csv'):
+            with open(filename, 'w', newline='') as f:
+                writer = csv.DictWriter(f, RECORD_FIELDS)
+                writer.writeheader()
+                writer.writerows(self.records)
+        else:
+            with open(filename, 'w') as f:
+                json.dump({'records': self.records, 'summary': self.summary()}, f, indent=1)
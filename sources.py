@@ -0,0 +1,171 @@
+#
+# Inputs of the page pipeline: each source has a name (used to name the
+# page image in the book) and the encoded image bytes.
+#
+import tarfile
+import threading
+import zipfile
+from collections import OrderedDict
+from io import BytesIO
+from os import listdir, path, stat
+
+IMAGE_EXTENSIONS = ['.jpg', '.png']
+# comic book archives: zip (.cbz) and uncompressed tar (.cbt)
+ZIP_EXTENSIONS = ['.cbz', '.zip']
+TAR_EXTENSIONS = ['.cbt', '.tar']
+# zip files kept open by a process (a batch has a few books in flight)
+MAX_OPEN_ZIPS = 4
+
+
+# an image file in the input folder
+class FileSource:
+    def __init__(self, filename):
+        self.name = filename
+        # the file the page is built from, for incremental builds
+        self.path = filename
+
+    def read(self):
+        with open(self.path, 'rb') as f:
+            return f.read()
+
+
+# an image already in memory
+class MemorySource:
+    def __init__(self, name, data):
+        self.name = name
+        self.path = None
+        self.data = data
+
+    def read(self):
+        return self.data
+
+
+# a member of a zip file, read when the page is built (by the worker
+# process in parallel builds), stored members are not even inflated
+class ZipMemberSource:
+    def __init__(self, name, filename, member):
+        self.name = name
+        self.path = None
+        self.filename = filename
+        self.member = member
+
+    def read(self):
+        return open_zip(self.filename).read(self.member)
+
+
+# The zip files open in this process, by file name: (version, ZipFile).
+# Opening one reads its whole central directory, for each page that would
+# make reading a book O(pages^2). A file changed since it was opened (a
+# long running process, see epubd.py) is opened again.
+_zips = OrderedDict()
+_zips_lock = threading.Lock()
+
+def open_zip(filename):
+    st = stat(filename)
+    version = (st.st_mtime_ns, st.st_size)
+    with _zips_lock:
+        entry = _zips.pop(filename, None)
+        if entry and entry[0] != version:
+            entry[1].close()
+            entry = None
+        _zips[filename] = entry = entry or (version, zipfile.ZipFile(filename))
+        while len(_zips) > MAX_OPEN_ZIPS:
+            _zips.popitem(last=False)[1][1].close()
+        return entry[1]
+
+
+# a member of an uncompressed tar file: a slice of it
+class TarMemberSource:
+    def __init__(self, name, filename, offset, size):
+        self.name = name
+        self.path = None
+        self.filename = filename
+        self.offset = offset
+        self.size = size
+
+    def read(self):
+        with open(self.filename, 'rb') as f:
+            f.seek(self.offset)
+            return f.read(self.size)
+
+
+def is_pdf(filename):
+    return path.isfile(filename) and path.splitext(filename)[1].lower() == '.pdf'
+
+
+def is_archive(filename):
+    return path.isfile(filename) and path.splitext(filename)[1].lower() in ZIP_EXTENSIONS + TAR_EXTENSIONS
+
+
+def is_archive_image(name):
+    base = path.basename(name)
+    return path.splitext(base)[1].lower() in IMAGE_EXTENSIONS + ['.jpeg'] \
+        and not base.startswith('.') and not name.startswith('__MACOSX/')
+
+
+# the page names keep the folders, in case two have the same file names
+def page_name(member):
+    return member.replace('/', '_')
+
+
+# Images of an archive, in name order, wherever they are in it. Only the
+# list of members is read here, the images are read as the pages are built.
+def archive_sources(filename):
+    if path.splitext(filename)[1].lower() in ZIP_EXTENSIONS:
+        with zipfile.ZipFile(filename) as z:
+            members = sorted(i.filename for i in z.infolist() if not i.is_dir() and is_archive_image(i.filename))
+        for member in members:
+            yield ZipMemberSource(page_name(member), filename, member)
+    else:
+        with open_tar(filename) as t:
+            members = sorted((i for i in t.getmembers() if i.isfile() and is_archive_image(i.name)), key=lambda i: i.name)
+        for member in members:
+            yield TarMemberSource(page_name(member.name), filename, member.offset_data, member.size)
+
+
+# the offsets of the members are only good in an uncompressed tar
+def open_tar(filename):
+    try:
+        return tarfile.open(filename, 'r:')
+    except tarfile.ReadError as e:
+        try:
+            tarfile.open(filename, 'r:*').close()
+        except tarfile.TarError:
+            # not a tar at all
+            raise e
+        raise Exception(filename + ': compressed tar not supported, uncompress it first')
+
+
+def dir_sources(input_dir, exclude=None):
+    for f in sorted(listdir(input_dir)):
+        if path.splitext(f)[1] in IMAGE_EXTENSIONS:
+            f = path.join(input_dir, f)
+            if exclude and path.realpath(f) == path.realpath(exclude):
+                continue
+            yield FileSource(f)
+
+
+# Images of a PDF, one page at a time. JPEG streams are passed on as they are
+# stored in the PDF, anything else is re-encoded losslessly as PNG.
+def pdf_sources(filename):
+    from pdftools import ImageExtractor
+
+    with ImageExtractor(filename) as extractor:
+        for name, img in extractor.iter_named_images(raw=True):
+            if isinstance(img, tuple):
+                data = img[0]
+            else:
+                buf = BytesIO()
+                img.save(buf, 'PNG')
+                data = buf.getvalue()
+            yield MemorySource(name, data)
+
+
+def input_sources(input_path, exclude=None):
+    if path.isdir(input_path):
+        return dir_sources(input_path, exclude)
+    if is_pdf(input_path):
+        return pdf_sources(input_path)
+    if is_archive(input_path):
+        return archive_sources(input_path)
+    raise Exception(input_path + ' is not a directory, a PDF file or a comic archive')